@@ -0,0 +1,154 @@
+import asyncio
+import json
+import os
+import signal
+import time
+
+# Optional JSON file overriding the limits below, e.g. {"user_rate": 5, "max_in_flight": 2000}.
+# It is re-read on SIGHUP and whenever its modification time changes.
+LIMITS_FILE = os.environ.get("LIMITS_FILE", "")
+LIMITS_CHECK_INTERVAL = 5
+
+# Defaults; every key can also be set in LIMITS_FILE
+DEFAULT_LIMITS = {
+    # Frames per second per user, with bursts up to user_burst
+    "user_rate": float(os.environ.get("USER_RATE", "20")),
+    "user_burst": float(os.environ.get("USER_BURST", "40")),
+    # Messages per second into one group, whoever sends them
+    "group_rate": float(os.environ.get("GROUP_RATE", "50")),
+    "group_burst": float(os.environ.get("GROUP_BURST", "100")),
+    # Largest accepted "content" field, in characters
+    "max_content_bytes": int(os.environ.get("MAX_CONTENT_BYTES", str(64 * 1024))),
+    # Frames being handled at once across all connections before new ones are shed
+    "max_in_flight": int(os.environ.get("MAX_IN_FLIGHT", "1000")),
+}
+
+# Hard cap on an incoming WebSocket frame; larger frames close the connection.
+# Fixed at startup because it is enforced by the websockets library.
+MAX_FRAME_BYTES = int(os.environ.get("MAX_FRAME_BYTES", str(1024 * 1024)))
+
+IDLE_SWEEP_INTERVAL = 60
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """Returns 0 if a token was taken, else seconds until one is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class Admission:
+    """Rate limits, size limits and the in-flight budget for client frames."""
+
+    def __init__(self, path=LIMITS_FILE):
+        self.path = path
+        self.limits = dict(DEFAULT_LIMITS)
+        self.in_flight = 0
+        self._users = {}  # {username or session: TokenBucket}
+        self._groups = {}  # {group name: TokenBucket}
+        self._mtime = None
+        self._task = None
+        self.reload()
+
+    def reload(self):
+        # Unknown keys and bad files are reported and the previous limits kept
+        if not self.path:
+            return
+        try:
+            self._mtime = os.path.getmtime(self.path)
+            with open(self.path) as f:
+                overrides = json.load(f)
+            unknown = set(overrides) - set(DEFAULT_LIMITS)
+            if unknown:
+                raise ValueError(f"unknown keys {sorted(unknown)}")
+            limits = dict(DEFAULT_LIMITS)
+            limits.update({key: type(DEFAULT_LIMITS[key])(value) for key, value in overrides.items()})
+        except (OSError, ValueError, TypeError) as e:
+            print(f"Error loading limits from {self.path}: {e}")
+            return
+        self.limits = limits
+        # Buckets pick up the new rates; they start full again
+        self._users.clear()
+        self._groups.clear()
+        print(f"Limits loaded from {self.path}: {limits}")
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self.reload)
+        except (NotImplementedError, RuntimeError):
+            pass  # No SIGHUP here; the mtime check still applies
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        since_sweep = 0
+        while True:
+            await asyncio.sleep(LIMITS_CHECK_INTERVAL)
+            if self.path:
+                try:
+                    if os.path.getmtime(self.path) != self._mtime:
+                        self.reload()
+                except OSError:
+                    pass
+            since_sweep += LIMITS_CHECK_INTERVAL
+            if since_sweep >= IDLE_SWEEP_INTERVAL:
+                since_sweep = 0
+                self.sweep()
+
+    def sweep(self):
+        # A full bucket is the same as no bucket, so idle senders cost no memory
+        now = time.monotonic()
+        for buckets in (self._users, self._groups):
+            for key in [key for key, bucket in buckets.items() if bucket.full(now)]:
+                del buckets[key]
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+
+    def try_enter(self):
+        if self.in_flight >= self.limits["max_in_flight"]:
+            return False
+        self.in_flight += 1
+        return True
+
+    def leave(self):
+        self.in_flight -= 1
+
+    def check_user(self, key):
+        bucket = self._users.get(key)
+        if bucket is None:
+            bucket = self._users[key] = TokenBucket(self.limits["user_rate"], self.limits["user_burst"])
+        return bucket.take(time.monotonic())
+
+    def check_group(self, group_name):
+        bucket = self._groups.get(group_name)
+        if bucket is None:
+            bucket = self._groups[group_name] = TokenBucket(self.limits["group_rate"], self.limits["group_burst"])
+        return bucket.take(time.monotonic())
+
+    def oversized(self, data):
+        content = data.get("content")
+        return isinstance(content, (str, bytes)) and len(content) > self.limits["max_content_bytes"]
+
+
+def throttled(message, retry_after=None):
+    reply = {"status": "error", "code": "throttled", "message": message}
+    if retry_after:
+        reply["retry_after"] = round(retry_after, 3)
+    return reply
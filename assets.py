@@ -0,0 +1,129 @@
+import gzip
+import hashlib
+import os
+import re
+from http import HTTPStatus
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # gzip always works; brotli is used when installed
+    brotli = None
+
+# The web client, served on the WebSocket port; empty disables it
+WEB_DIR = os.environ.get("WEB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "web"))
+
+CONTENT_TYPES = {
+    ".html": "text/html; charset=utf-8",
+    ".js": "text/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".json": "application/json",
+    ".svg": "image/svg+xml",
+    ".png": "image/png",
+    ".ico": "image/x-icon",
+}
+# Already-compressed formats are served as they are
+COMPRESSIBLE = {".html", ".js", ".css", ".json", ".svg"}
+
+# Pages are revalidated on every load, which costs a 304 when nothing changed.
+# Pages link everything else with ?v=<content hash>, so those never need asking about again.
+PAGE_CACHE_CONTROL = "no-cache"
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+REQUESTS = metrics.Counter("chat_web_requests_total", "Web client HTTP requests, by status.", ("status",))
+
+
+class Asset:
+    __slots__ = ("content_type", "etag", "cache_control", "bodies")
+
+    def __init__(self, name, data, cache_control):
+        extension = os.path.splitext(name)[1]
+        self.content_type = CONTENT_TYPES.get(extension, "application/octet-stream")
+        self.cache_control = cache_control
+        self.etag = f'W/"{content_hash(data)}"'  # Weak: one tag covers every encoding
+        self.bodies = {"identity": data}  # {content coding: bytes}
+        if extension in COMPRESSIBLE:
+            # Paid once at startup at the highest levels; kept only where it is smaller
+            candidates = {"gzip": gzip.compress(data, compresslevel=9, mtime=0)}
+            if brotli:
+                candidates["br"] = brotli.compress(data, quality=11)
+            for coding, body in candidates.items():
+                if len(body) < len(data):
+                    self.bodies[coding] = body
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def accepted_codings(accept_encoding):
+    # Codings the client takes, ignoring the ones it refuses with q=0
+    codings = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        if re.fullmatch(r"\s*q\s*=\s*0(\.0*)?\s*", params):
+            continue
+        codings.add(coding.strip().lower())
+    return codings
+
+
+class Assets:
+    """The web client's files, compressed once at startup and served from memory."""
+
+    def __init__(self, directory=WEB_DIR):
+        self.directory = directory
+        self._assets = {}  # {URL path: Asset}
+
+    def __len__(self):
+        return len(self._assets)
+
+    def load(self):
+        if not self.directory:
+            return
+        try:
+            names = sorted(name for name in os.listdir(self.directory)
+                           if os.path.isfile(os.path.join(self.directory, name)))
+        except OSError as e:
+            print(f"Error loading web client from {self.directory}: {e}")
+            return
+        files = {}
+        for name in names:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                files[name] = f.read()
+
+        versions = {}
+        for name, data in files.items():
+            if not name.endswith(".html"):
+                self._assets["/" + name] = Asset(name, data, ASSET_CACHE_CONTROL)
+                versions[name] = content_hash(data)
+        for name, data in files.items():
+            if name.endswith(".html"):
+                # Links to our own files carry their hash, so a new deploy is fetched at once
+                for linked, version in versions.items():
+                    data = data.replace(f'"{linked}"'.encode(), f'"{linked}?v={version}"'.encode())
+                self._assets["/" + name] = Asset(name, data, PAGE_CACHE_CONTROL)
+        if "/index.html" in self._assets:
+            self._assets["/"] = self._assets["/index.html"]
+        print(f"Serving {len(files)} web client files from {self.directory} (brotli {'on' if brotli else 'off'})")
+
+    def respond(self, path, request_headers):
+        asset = self._assets.get(path.partition("?")[0])
+        if asset is None:
+            REQUESTS.inc(status="404")
+            return HTTPStatus.NOT_FOUND, [], b"Not found\n"
+        headers = [("ETag", asset.etag), ("Cache-Control", asset.cache_control), ("Vary", "Accept-Encoding")]
+        if_none_match = request_headers.get("If-None-Match", "")
+        if if_none_match:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or asset.etag.removeprefix("W/") in tags:
+                REQUESTS.inc(status="304")
+                return HTTPStatus.NOT_MODIFIED, headers, b""
+
+        accepted = accepted_codings(request_headers.get("Accept-Encoding", ""))
+        coding = next((coding for coding in ("br", "gzip") if coding in accepted and coding in asset.bodies), "identity")
+        headers.append(("Content-Type", asset.content_type))
+        if coding != "identity":
+            headers.append(("Content-Encoding", coding))
+        REQUESTS.inc(status="200")
+        return HTTPStatus.OK, headers, asset.bodies[coding]
@@ -0,0 +1,58 @@
+import argparse
+import base64
+import time
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import client
+
+# Private-message crypto throughput for one sender/receiver pair, measured as
+# encrypt on the sender plus decrypt on the receiver, without any network.
+
+def legacy_message(peer_public_key, peer_private_key, text):
+    # Previous scheme: a fresh Fernet key and an RSA-OAEP round trip for every message
+    session_key = Fernet.generate_key()
+    content = Fernet(session_key).encrypt(text)
+    encrypted_key = base64.b64encode(peer_public_key.encrypt(session_key, client.OAEP))
+    fernet_key = peer_private_key.decrypt(base64.b64decode(encrypted_key), client.OAEP)
+    return Fernet(fernet_key).decrypt(content)
+
+def run_legacy(count, peer_public_key, peer_private_key, text):
+    for _ in range(count):
+        legacy_message(peer_public_key, peer_private_key, text)
+
+def run_sessions(count, peer_public_key, text):
+    # Current scheme, using the client's own session and decrypt code
+    session = client.new_outgoing_session(peer_public_key)
+    for i in range(count):
+        data = {
+            "from": "bench",
+            "key_id": session["id"],
+            "content": session["cipher"].encrypt(text).decode()
+        }
+        if i == 0:
+            data["encrypted_key"] = session["encrypted_key"]
+        decrypted, _ = client.decrypt_private(data)
+        assert decrypted.endswith(text.decode())
+
+def measure(label, func, count, *args):
+    started = time.perf_counter()
+    func(count, *args)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {count:>7} msgs  {elapsed:8.3f} s  {count / elapsed:10.0f} msg/s")
+    return count / elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Private message crypto throughput per peer")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=200, help="plaintext bytes per message")
+    args = parser.parse_args()
+
+    client.MY_PRIVATE_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    peer_public_key = client.MY_PRIVATE_KEY.public_key()
+    text = b"x" * args.size
+
+    before = measure("per-message RSA (before)", run_legacy, args.messages, peer_public_key, client.MY_PRIVATE_KEY, text)
+    after = measure("per-peer session (after)", run_sessions, args.messages, peer_public_key, text)
+    print(f"speedup: {after / before:.1f}x")
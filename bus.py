@@ -0,0 +1,241 @@
+import asyncio
+import itertools
+import json
+import os
+import struct
+import sys
+import time
+
+# Where workers find the hub: "unix:/path/to.sock" or "tcp:host:port".
+# Empty means single-process mode with the in-process LocalBus.
+BUS_ADDRESS = os.environ.get("BUS_ADDRESS", "")
+
+# Every bus message is: header length, body length, JSON header, raw body.
+# Frames destined for clients travel as the body so they are never re-encoded.
+_PREFIX = struct.Struct("!II")
+
+
+def _pack(header, body=b""):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    head = json.dumps(header).encode("utf-8")
+    return _PREFIX.pack(len(head), len(body)) + head + body
+
+
+async def _read(reader):
+    head_len, body_len = _PREFIX.unpack(await reader.readexactly(_PREFIX.size))
+    header = json.loads(await reader.readexactly(head_len))
+    body = await reader.readexactly(body_len) if body_len else b""
+    return header, body
+
+
+async def _open(address):
+    scheme, _, rest = address.partition(":")
+    if scheme == "unix":
+        return await asyncio.open_unix_connection(rest)
+    host, _, port = rest.rpartition(":")
+    return await asyncio.open_connection(host, int(port))
+
+
+async def _serve(handler, address):
+    scheme, _, rest = address.partition(":")
+    if scheme == "unix":
+        if os.path.exists(rest):
+            os.unlink(rest)
+        return await asyncio.start_unix_server(handler, rest)
+    host, _, port = rest.rpartition(":")
+    return await asyncio.start_server(handler, host, int(port))
+
+
+class LocalBus:
+    """Single-process bus: every user is local, so there is nothing to route."""
+
+    worker_id = 0
+
+    def __init__(self):
+        self._claims = set()
+
+    async def start(self, on_event, on_deliver, on_lost=None):
+        # Returns the users already online on other workers
+        return []
+
+    async def claim(self, username):
+        if username in self._claims:
+            return False
+        self._claims.add(username)
+        return True
+
+    async def release(self, username):
+        self._claims.discard(username)
+
+    async def send_to_user(self, username, frame, transient=False):
+        return False
+
+    async def publish(self, kind, payload, frame=""):
+        pass
+
+    async def close(self):
+        pass
+
+
+class RemoteBus:
+    """Worker side of the hub connection (Unix socket or TCP)."""
+
+    def __init__(self, address):
+        self.address = address
+        self.worker_id = None
+        self._reader = None
+        self._writer = None
+        self._pending = {}  # {request id: future}
+        self._ids = itertools.count(1)
+        self._task = None
+        self._lost = False
+
+    async def start(self, on_event, on_deliver, on_lost=None):
+        # on_lost is called if the hub goes away; the worker cannot route or claim without it
+        self._reader, self._writer = await _open(self.address)
+        self._writer.write(_pack({"op": "hello"}))
+        header, _ = await _read(self._reader)
+        self.worker_id = header["worker"]
+        self._task = asyncio.create_task(self._listen(on_event, on_deliver, on_lost))
+        return header["users"]
+
+    async def _listen(self, on_event, on_deliver, on_lost):
+        try:
+            while True:
+                header, body = await _read(self._reader)
+                op = header["op"]
+                if op == "reply":
+                    future = self._pending.pop(header["id"], None)
+                    if future and not future.done():
+                        future.set_result(header["ok"])
+                elif op == "deliver":
+                    on_deliver(header["user"], body.decode("utf-8"), header.get("transient", False))
+                elif op == "event":
+                    on_event(header["kind"], header["payload"], body.decode("utf-8"))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("Lost connection to message bus")
+            self._lost = True
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_result(False)
+            self._pending.clear()
+            if on_lost:
+                on_lost()
+
+    async def _request(self, header, body=b""):
+        if self._lost:
+            return False  # Nobody would ever answer
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        header["id"] = request_id
+        self._writer.write(_pack(header, body))
+        return await future
+
+    async def claim(self, username):
+        # Cluster-wide "already logged in" check, decided by the hub
+        return await self._request({"op": "claim", "user": username})
+
+    async def release(self, username):
+        self._writer.write(_pack({"op": "release", "user": username}))
+
+    async def send_to_user(self, username, frame, transient=False):
+        # True if the user is online on another worker and the frame was handed over.
+        # Transient frames (protocol.TransientFrame) are not kept for resume there.
+        header = {"op": "route", "user": username}
+        if transient:
+            header["transient"] = True
+        return await self._request(header, frame)
+
+    async def publish(self, kind, payload, frame=""):
+        self._writer.write(_pack({"op": "publish", "kind": kind, "payload": payload}, frame))
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        if self._writer:
+            self._writer.close()
+
+
+class BusHub:
+    """Routes messages between workers and owns the cluster-wide presence table."""
+
+    def __init__(self):
+        self.workers = {}  # {worker id: StreamWriter}
+        self.owners = {}  # {username: worker id}
+        self._ids = itertools.count(1)
+
+    async def serve(self, address):
+        server = await _serve(self._handle_worker, address)
+        print(f"Message bus listening on {address}")
+        return server
+
+    async def _handle_worker(self, reader, writer):
+        worker_id = None
+        try:
+            header, _ = await _read(reader)
+            if header.get("op") != "hello":
+                return
+            worker_id = next(self._ids)
+            self.workers[worker_id] = writer
+            writer.write(_pack({"op": "welcome", "worker": worker_id, "users": list(self.owners)}))
+
+            while True:
+                header, body = await _read(reader)
+                op = header["op"]
+                if op == "claim":
+                    user = header["user"]
+                    ok = user not in self.owners
+                    if ok:
+                        self.owners[user] = worker_id
+                    writer.write(_pack({"op": "reply", "id": header["id"], "ok": ok}))
+                elif op == "release":
+                    if self.owners.get(header["user"]) == worker_id:
+                        del self.owners[header["user"]]
+                elif op == "route":
+                    owner = self.workers.get(self.owners.get(header["user"]))
+                    if owner:
+                        deliver = {"op": "deliver", "user": header["user"]}
+                        if header.get("transient"):
+                            deliver["transient"] = True
+                        owner.write(_pack(deliver, body))
+                    writer.write(_pack({"op": "reply", "id": header["id"], "ok": owner is not None}))
+                elif op == "publish":
+                    event = _pack({"op": "event", "kind": header["kind"], "payload": header["payload"]}, body)
+                    for other_id, other in self.workers.items():
+                        if other_id != worker_id:
+                            other.write(event)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if worker_id is not None:
+                # A dead worker's users are no longer logged in anywhere; the other
+                # workers are told, as that worker would have on each logout
+                self.workers.pop(worker_id, None)
+                now = time.time()
+                for user in [u for u, w in self.owners.items() if w == worker_id]:
+                    del self.owners[user]
+                    event = _pack({"op": "event", "kind": "presence", "payload": {"user": user, "online": False, "at": now}})
+                    for other in self.workers.values():
+                        other.write(event)
+                print(f"Worker {worker_id} left the bus")
+            writer.close()
+
+
+def get_bus(address=BUS_ADDRESS):
+    return RemoteBus(address) if address else LocalBus()
+
+
+async def run_hub(address):
+    server = await BusHub().serve(address)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    # Standalone hub for multi-host deployments, e.g. python bus.py tcp:0.0.0.0:9000
+    if len(sys.argv) != 2:
+        print("Usage: python bus.py <unix:/path.sock | tcp:host:port>")
+        sys.exit(1)
+    asyncio.run(run_hub(sys.argv[1]))
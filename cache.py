@@ -0,0 +1,81 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Size-bounded mapping with a per-entry TTL and read-through loading.
+
+    A cached None is a valid value (a known miss), so unknown keys do not
+    hit the database on every lookup.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # {key: (expires_at, value)}
+        self._loading = {}  # {key: future}, so concurrent misses share one load
+
+    def __len__(self):
+        return len(self._data)
+
+    def peek(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    async def fetch(self, key, loader):
+        value = self.peek(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+        future = self._loading.get(key)
+        if future is None:
+            future = self._loading[key] = asyncio.ensure_future(loader(key))
+            try:
+                value = await future
+            finally:
+                del self._loading[key]
+            self.set(key, value)
+            return value
+        return await asyncio.shield(future)
+
+    async def fetch_many(self, keys, loader):
+        # loader takes the missing keys and returns {key: value} for those it found;
+        # keys it does not return are cached as None
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.peek(key, _MISSING)
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        self.hits += len(found)
+        self.misses += len(missing)
+        if missing:
+            loaded = await loader(missing)
+            for key in missing:
+                found[key] = loaded.get(key)
+                self.set(key, found[key])
+        return found
@@ -2,107 +2,830 @@ import asyncio
 import websockets
 import json
 import threading
-import sys
 import base64
+import hashlib
+import os
+import re
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import serialization, hashes
 
+import protocol
+
+# Identity keys and known contact keys live here between runs
+CLIENT_DIR = os.path.expanduser(os.environ.get("CHAT_CLIENT_DIR", "~/.chat_platform"))
+
 # Store my keys
 MY_PRIVATE_KEY = None
 MY_PUBLIC_PEM = None
 
+OAEP = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None
+)
+
+# RSA and Fernet work runs here so the receive loop never waits on it
+crypto_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="crypto")
+
+# Per-peer session keys: RSA is only used when a session is created or rotated
+SESSION_MAX_AGE = float(os.environ.get("SESSION_MAX_AGE", "3600"))
+SESSION_MAX_MESSAGES = int(os.environ.get("SESSION_MAX_MESSAGES", "10000"))
+outgoing_sessions = {}  # {peer: {"id", "cipher", "encrypted_key", "fingerprint", "created", "sent"}}
+incoming_sessions = {}  # {(peer, key_id): Fernet}
+session_locks = {}  # {peer: asyncio.Lock}
+
+# Decryptions finish in any order on the pool; output is printed in arrival order
+display_queue = asyncio.Queue()
+
 # Store others' public keys: {username: rsa_public_key_object}
 key_store = {}
 
-# Pending key requests: {target_username: asyncio.Event}
-key_events = {}
+# Pending key requests: {target_username: [asyncio.Future]}, one future per waiting sender
+key_waiters = {}
+
+# Known keys persisted between runs: PEMs keyed by fingerprint, plus which fingerprint each user has
+KNOWN_KEYS_FILE = os.environ.get("KNOWN_KEYS_FILE", os.path.join(CLIENT_DIR, "known_keys.json"))
+known_keys = {}  # {fingerprint: pem}
+known_fingerprints = {}  # {username: fingerprint}
+
+# Members of my groups who are online, kept current by presence deltas
+online_users = set()
+
+# Outgoing frames are JSON until the server accepts a binary codec at login
+codec = protocol.JSON
 
-# Hardcoded key for Groups (Fallback)
-GROUP_KEY = b'Z7w1B8td3b1N0c9n0m8-j0n7I6k5l4m3n2o1p0q9r8s=' 
-group_cipher = Fernet(GROUP_KEY)
+# Reliable delivery: the server numbers its frames and we ack them, so a dropped
+# connection can resume the session without logging in again
+RECONNECT_DELAY = float(os.environ.get("RECONNECT_DELAY", "1"))
+ACK_EVERY = 32  # Frames between acks while traffic is flowing
+ACK_DELAY = 0.2  # Seconds before a lone frame is acked
+resume_token = None
+last_seq = 0  # Highest sequence number received
+acked_seq = 0
+ack_timer = None
+
+# Sender keys: each member encrypts group messages with their own Fernet key per
+# group, wrapped once for every other member with that member's RSA key. Sending
+# is then one symmetric encryption however big the group; RSA only runs on rotation.
+SENDER_KEY_MAX_AGE = float(os.environ.get("SENDER_KEY_MAX_AGE", "86400"))
+SENDER_KEY_MAX_MESSAGES = int(os.environ.get("SENDER_KEY_MAX_MESSAGES", "100000"))
+ENVELOPES_PER_REQUEST = 500
+KEYS_PER_REQUEST = 1000
+my_username = None
+my_sender_keys = {}  # {group: {"id", "key", "cipher", "created", "sent", "stale"}}
+sender_keys = {}  # {(sender, key_id): Future of a Fernet, or of None if the envelope was unreadable}
+missing_sender_keys = {}  # {(sender, key_id): [group frames waiting for that key]}
+group_locks = {}  # {group: asyncio.Lock}
+members_waiters = {}  # {group: [asyncio.Future]}
+
+# File transfers: a file is encrypted chunk by chunk and streamed, so no one holds
+# all of it in memory. The receiver grants credit for FILE_WINDOW chunks at a time
+# and writes into a .part file, so a dropped transfer resumes from the first chunk
+# it is missing, even after a restart.
+FILE_CHUNK_BYTES = int(os.environ.get("FILE_CHUNK_BYTES", "32768"))
+FILE_WINDOW = int(os.environ.get("FILE_WINDOW", "8"))
+FILE_STALL_TIMEOUT = float(os.environ.get("FILE_STALL_TIMEOUT", "5"))
+DOWNLOAD_DIR = os.path.expanduser(os.environ.get("CHAT_DOWNLOAD_DIR", os.path.join(CLIENT_DIR, "downloads")))
+CHUNK_INDEX = struct.Struct("!I")  # Sealed into each chunk so chunks cannot be swapped
+outgoing_files = {}  # {transfer id: {"target", "path", "name", "size", "chunks", "cipher", "offer", "next", "limit", "done", "wakeup"}}
+incoming_files = {}  # {transfer id: {"from", "name", "size", "chunk_size", "chunks", "cipher", "file", "next", "stored", "granted", "progress", "restarting"}}
+file_offers = {}  # {transfer id: offer waiting for /accept}
+
+def load_identity(username):
+    # Reuse this user's key pair across runs; only the first run pays for RSA generation
+    global MY_PRIVATE_KEY
+    safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", username)
+    path = os.path.join(CLIENT_DIR, f"{safe_name}.identity.pem")
+    try:
+        with open(path, "rb") as f:
+            MY_PRIVATE_KEY = serialization.load_pem_private_key(f.read(), password=None)
+    except (OSError, ValueError):
+        generate_keys()
+        os.makedirs(CLIENT_DIR, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(MY_PRIVATE_KEY.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            ))
+    set_public_pem()
 
 def generate_keys():
-    global MY_PRIVATE_KEY, MY_PUBLIC_PEM
+    global MY_PRIVATE_KEY
     print("Generating RSA keys...")
     MY_PRIVATE_KEY = rsa.generate_private_key(
         public_exponent=65537,
         key_size=2048
     )
+    set_public_pem()
+
+def set_public_pem():
+    global MY_PUBLIC_PEM
     public_key = MY_PRIVATE_KEY.public_key()
     MY_PUBLIC_PEM = public_key.public_bytes(
         encoding=serialization.Encoding.PEM,
         format=serialization.PublicFormat.SubjectPublicKeyInfo
     ).decode('utf-8')
 
-async def listen(websocket):
+def key_fingerprint(pem):
+    return hashlib.sha256(pem.encode('utf-8')).hexdigest()
+
+def load_known_keys():
+    try:
+        with open(KNOWN_KEYS_FILE) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return
+    known_keys.update(saved.get("keys", {}))
+    for username, fingerprint in saved.get("users", {}).items():
+        if fingerprint in known_keys:
+            known_fingerprints[username] = fingerprint
+            key_store[username] = serialization.load_pem_public_key(known_keys[fingerprint].encode('utf-8'))
+
+def save_known_keys():
+    # Only keep PEMs that some user still points at
+    in_use = set(known_fingerprints.values())
+    saved = {
+        "keys": {fp: pem for fp, pem in known_keys.items() if fp in in_use},
+        "users": known_fingerprints
+    }
+    os.makedirs(os.path.dirname(KNOWN_KEYS_FILE) or ".", exist_ok=True)
+    tmp_path = KNOWN_KEYS_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(saved, f)
+    os.replace(tmp_path, KNOWN_KEYS_FILE)
+
+def remember_key(username, pem, fingerprint=None):
+    fingerprint = fingerprint or key_fingerprint(pem)
+    known_keys[fingerprint] = pem
+    known_fingerprints[username] = fingerprint
+    key_store[username] = serialization.load_pem_public_key(pem.encode('utf-8'))
+
+def resolve_key_waiters(username):
+    for future in key_waiters.pop(username, []):
+        if not future.done():
+            future.set_result(key_store.get(username))
+
+async def fetch_keys(websocket, targets):
+    # One round trip for any number of users; keys we already hold are only revalidated
+    loop = asyncio.get_running_loop()
+    futures = []
+    for target in targets:
+        future = loop.create_future()
+        key_waiters.setdefault(target, []).append(future)
+        futures.append(future)
+    targets = list(targets)
+    for start in range(0, len(targets), KEYS_PER_REQUEST):
+        await send(websocket, {
+            "action": "get_keys",
+            "targets": {target: known_fingerprints.get(target) for target in targets[start:start + KEYS_PER_REQUEST]}
+        })
+    try:
+        await asyncio.wait_for(asyncio.gather(*futures), timeout=5.0)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        for target, future in zip(targets, futures):
+            if future in key_waiters.get(target, []):
+                key_waiters[target].remove(future)
+                if not key_waiters[target]:
+                    del key_waiters[target]
+    return {target: key_store.get(target) for target in targets}
+
+async def send(websocket, message):
+    await websocket.send(codec.encode(message))
+
+def handle_message(data):
+    global codec, resume_token, last_seq, acked_seq
+    if "status" in data:
+        print(f"[Server] {data['message']}")
+        if data.get("protocol") in protocol.CODECS:
+            codec = protocol.CODECS[data["protocol"]]
+        if data.get("resume_token"):
+            resume_token = data["resume_token"]
+            if not data.get("resumed"):
+                # A new session numbers its frames from 1 again
+                last_seq = acked_seq = 0
+            # Transfers carry on: we ask for the chunks we are missing, and after a new
+            # login (which ends our transfers on the server) we offer our files again
+            for transfer_id, incoming in incoming_files.items():
+                queue_reply(file_credit(transfer_id, incoming, restart=True))
+            if not data.get("resumed"):
+                for transfer in outgoing_files.values():
+                    transfer["next"] = transfer["limit"] = 0
+                    queue_reply(transfer["offer"])
+        if data["status"] == "error" and data.get("transfer_id") in outgoing_files:
+            drop_transfer(data["transfer_id"])
+        # If server advertises a default model, show it
+        default_model = data.get("default_model")
+        if default_model:
+            print(f"[Server] Default model: {default_model}")
+    
+    elif "type" in data:
+        msg_type = data["type"]
+
+        if msg_type == "pub_key":
+            # Received a requested public key
+            username = data["username"]
+            remember_key(username, data["key"], data.get("fingerprint"))
+            save_known_keys()
+            resolve_key_waiters(username)
+
+        elif msg_type == "pub_keys":
+            # Batched reply: new or changed keys, still-valid ones, and unknown users
+            for username, entry in data["keys"].items():
+                remember_key(username, entry["key"], entry["fingerprint"])
+            for username in data["unchanged"]:
+                if username not in key_store:
+                    pem = known_keys[known_fingerprints[username]]
+                    key_store[username] = serialization.load_pem_public_key(pem.encode('utf-8'))
+            for username in data["missing"]:
+                known_fingerprints.pop(username, None)
+                key_store.pop(username, None)
+            if data["keys"] or data["missing"]:
+                save_known_keys()
+            for username in list(data["keys"]) + data["unchanged"] + data["missing"]:
+                resolve_key_waiters(username)
+        
+        elif msg_type == "private":
+            if data.get("control") == "rekey":
+                # The peer lost our session key; the next message starts a new session
+                outgoing_sessions.pop(data['from'], None)
+                return
+            loop = asyncio.get_running_loop()
+            if data.get("control") == "sender_key":
+                # A member could not read my group messages; send them the key again
+                display_queue.put_nowait(asyncio.ensure_future(answer_sender_key_request(data)))
+                return
+            display_queue.put_nowait(loop.run_in_executor(crypto_pool, decrypt_private, data))
+
+        elif msg_type == "history":
+            # Page of stored messages, oldest first
+            label = data.get("group") or data.get("with")
+            print(f"\n--- History for {label} ({len(data['messages'])} messages) ---")
+            for entry in data["messages"]:
+                stored = entry["message"]
+                if stored.get("type") == "group":
+                    text = decrypt_stored_group(stored)
+                else:
+                    text = "<Encrypted>"
+                print(f"[{stored['from']}]: {text}")
+
+        elif msg_type == "group":
+            display_queue.put_nowait(asyncio.ensure_future(decrypt_group_message(data)))
+
+        elif msg_type == "sender_key":
+            # A member's key for their messages in a group, wrapped with my RSA key
+            loop = asyncio.get_running_loop()
+            sender_key = (data["from"], data["key_id"])
+            sender_keys[sender_key] = loop.run_in_executor(crypto_pool, unwrap_sender_key, data)
+            for waiting in missing_sender_keys.pop(sender_key, []):
+                display_queue.put_nowait(asyncio.ensure_future(decrypt_group_message(waiting)))
+
+        elif msg_type == "members":
+            for future in members_waiters.pop(data["group"], []):
+                if not future.done():
+                    future.set_result(data["members"])
+
+        elif msg_type == "member":
+            # Membership changed: my next message in the group uses a fresh key
+            key = my_sender_keys.get(data["group"])
+            if key:
+                key["stale"] = True
+            print(f"[Group {data['group']}] {data['user']} joined")
+
+        elif msg_type == "file_offer":
+            display_queue.put_nowait(asyncio.ensure_future(receive_file_offer(data)))
+
+        elif msg_type == "file_chunk":
+            receive_file_chunk(data)
+
+        elif msg_type == "file_credit":
+            transfer = outgoing_files.get(data["transfer_id"])
+            if transfer is None:
+                return
+            if data["next"] >= transfer["chunks"]:
+                drop_transfer(data["transfer_id"])
+                print(f"[File] {transfer['target']} received {transfer['name']}")
+            elif data.get("restart"):
+                # Chunks were lost on the way; send again from the first missing one
+                transfer["next"] = data["next"]
+                transfer["limit"] = data["next"] + data["window"]
+            else:
+                transfer["limit"] = max(transfer["limit"], data["next"] + data["window"])
+            transfer["wakeup"].set()
+
+        elif msg_type == "file_cancel":
+            dropped = drop_transfer(data["transfer_id"])
+            if dropped:
+                print(f"[File] {data['from']} cancelled {dropped[0]}")
+
+        elif msg_type == "presence":
+            # One delta per server tick: who came online, who left, who is typing where
+            online = set(data.get("online", ())) - online_users
+            offline = set(data.get("offline", ())) & online_users
+            online_users.update(online)
+            online_users.difference_update(offline)
+            if online:
+                print(f"[Online] {', '.join(sorted(online))}")
+            if offline:
+                print(f"[Offline] {', '.join(sorted(offline))}")
+            for group, users in data.get("typing", {}).items():
+                print(f"[Group {group}] {', '.join(users)} typing...")
+
+def decrypt_private(data):
+    # Runs on the crypto pool. Returns (text to show, message to send back or None).
+    sender = data['from']
+    key_id = data.get('key_id')
+    try:
+        cipher = incoming_sessions.get((sender, key_id)) if key_id else None
+        if cipher is None:
+            # 1. Decrypt the session key with my private key (once per session)
+            encrypted_key_b64 = data.get('encrypted_key')
+            if not encrypted_key_b64:
+                rekey = {"action": "private", "target": sender, "control": "rekey"}
+                return f"[Private from {sender}]: <Missing session key, asked {sender} to rekey>", rekey
+            fernet_key = MY_PRIVATE_KEY.decrypt(base64.b64decode(encrypted_key_b64), OAEP)
+            cipher = Fernet(fernet_key)
+            if key_id:
+                incoming_sessions[(sender, key_id)] = cipher
+
+        # 2. Decrypt content using the session key
+        decrypted_content = cipher.decrypt(data['content'].encode()).decode()
+        return f"[Private from {sender}]: {decrypted_content}", None
+    except Exception as e:
+        return f"[Private from {sender}]: <Decryption Error: {e}>", None
+
+def decrypt_group(data, cipher):
+    # Runs on the crypto pool
+    try:
+        decrypted_content = cipher.decrypt(data['content'].encode()).decode()
+        return f"[Group {data['group']} - {data['from']}]: {decrypted_content}", None
+    except Exception as e:
+        return f"[Group {data['group']} - {data['from']}]: <Decryption Error: {e}>", None
+
+async def decrypt_group_message(data):
+    sender, key_id = data["from"], data.get("key_id")
+    if key_id is None:
+        # Web clients post plain text
+        return f"[Group {data['group']} - {sender}] (unencrypted): {data['content']}", None
+    future = sender_keys.get((sender, key_id))
+    if future is None:
+        # Shown once the key arrives; only the first message asks for it
+        waiting = missing_sender_keys.setdefault((sender, key_id), [])
+        waiting.append(data)
+        if len(waiting) > 1:
+            return None, None
+        request = {"action": "private", "target": sender, "control": "sender_key", "key_id": key_id}
+        return f"[Group {data['group']} - {sender}]: <Waiting for {sender}'s sender key>", request
+    cipher = await future
+    if cipher is None:
+        return f"[Group {data['group']} - {sender}]: <Unreadable sender key>", None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(crypto_pool, decrypt_group, data, cipher)
+
+def decrypt_stored_group(stored):
+    # History is decrypted with whichever sender keys this session has already received
+    if stored.get("key_id") is None:
+        return stored["content"]
+    future = sender_keys.get((stored["from"], stored["key_id"]))
+    if future is None or not future.done() or future.result() is None:
+        return "<Encrypted>"
+    try:
+        return future.result().decrypt(stored["content"].encode()).decode()
+    except Exception:
+        return "<Decryption Error>"
+
+def new_sender_key():
+    key = Fernet.generate_key()
+    return {"id": os.urandom(8).hex(), "key": key, "cipher": Fernet(key),
+            "created": time.monotonic(), "sent": 0, "stale": False}
+
+def wrap_sender_key(key, peer_keys):
+    # Runs on the crypto pool: one RSA encryption per member, once per rotation
+    return {peer: base64.b64encode(peer_key.encrypt(key, OAEP)).decode('utf-8') for peer, peer_key in peer_keys.items()}
+
+def unwrap_sender_key(data):
+    # Runs on the crypto pool
+    try:
+        return Fernet(MY_PRIVATE_KEY.decrypt(base64.b64decode(data["encrypted_key"]), OAEP))
+    except Exception:
+        return None
+
+async def fetch_members(websocket, group):
+    future = asyncio.get_running_loop().create_future()
+    members_waiters.setdefault(group, []).append(future)
+    await send(websocket, {"action": "members", "group": group})
+    try:
+        return await asyncio.wait_for(future, timeout=5.0)
+    except asyncio.TimeoutError:
+        return None
+
+async def get_sender_key(websocket, group):
+    lock = group_locks.setdefault(group, asyncio.Lock())
+    async with lock:
+        key = my_sender_keys.get(group)
+        # Rotate when membership changed, and on age or message count
+        if (key is None or key["stale"]
+                or time.monotonic() - key["created"] > SENDER_KEY_MAX_AGE
+                or key["sent"] >= SENDER_KEY_MAX_MESSAGES):
+            members = await fetch_members(websocket, group)
+            if members is None:
+                return None
+            peers = [member for member in members if member != my_username]
+            found = await fetch_keys(websocket, peers) if peers else {}
+            peer_keys = {peer: peer_key for peer, peer_key in found.items() if peer_key}
+            loop = asyncio.get_running_loop()
+            key = new_sender_key()
+            envelopes = await loop.run_in_executor(crypto_pool, wrap_sender_key, key["key"], peer_keys)
+            # The server hands each member only their own envelope
+            names = list(envelopes)
+            for start in range(0, len(names), ENVELOPES_PER_REQUEST):
+                await send(websocket, {
+                    "action": "sender_key",
+                    "group": group,
+                    "key_id": key["id"],
+                    "envelopes": {name: envelopes[name] for name in names[start:start + ENVELOPES_PER_REQUEST]}
+                })
+            my_sender_keys[group] = key
+            # Lets history show my own messages too
+            own = loop.create_future()
+            own.set_result(key["cipher"])
+            sender_keys[(my_username, key["id"])] = own
+        return key
+
+async def answer_sender_key_request(data):
+    requester, key_id = data["from"], data.get("key_id")
+    for group, key in my_sender_keys.items():
+        if key["id"] == key_id:
+            break
+    else:
+        return None, None  # Rotated since; the next key reaches every member
+    peer_key = key_store.get(requester)
+    if peer_key is None:
+        # Not a member when the key was made; the next message rotates and includes them
+        key["stale"] = True
+        return None, None
+    loop = asyncio.get_running_loop()
+    envelopes = await loop.run_in_executor(crypto_pool, wrap_sender_key, key["key"], {requester: peer_key})
+    return None, {"action": "sender_key", "group": group, "key_id": key_id, "envelopes": envelopes}
+
+async def send_group_message(websocket, group, content):
+    key = await get_sender_key(websocket, group)
+    if key is None:
+        print(f"Error: Could not set up a sender key for {group}")
+        return
+    key["sent"] += 1
+    encrypted_content = key["cipher"].encrypt(content.encode()).decode()
+    await send(websocket, {"action": "group", "group": group, "content": encrypted_content, "key_id": key["id"]})
+
+def queue_reply(message):
+    # Sent by the printer, in order with the other replies
+    future = asyncio.get_running_loop().create_future()
+    future.set_result((None, message))
+    display_queue.put_nowait(future)
+
+def find_transfer(prefix, *tables):
+    # Transfers are named by the first characters of their id
+    for table in tables:
+        for transfer_id in table:
+            if transfer_id.startswith(prefix):
+                return transfer_id
+    return None
+
+def part_path(transfer_id):
+    # Ids come from the peer; only the hex form can ever name a file
+    if not protocol.valid_transfer_id(transfer_id):
+        raise ValueError(f"Invalid transfer id {transfer_id!r}")
+    return os.path.join(DOWNLOAD_DIR, f"{transfer_id}.part")
+
+def file_credit(transfer_id, incoming, restart=False):
+    # Everything below "next" is ours; a restart also rewinds the sender there
+    next_index = incoming["next"] if restart else incoming["stored"]
+    incoming["granted"] = next_index
+    return {"action": "file_credit", "transfer_id": transfer_id, "next": next_index,
+            "window": FILE_WINDOW, "restart": restart}
+
+def drop_transfer(transfer_id):
+    # Forgets a transfer in either direction; returns (name, peer) or None
+    transfer = outgoing_files.pop(transfer_id, None)
+    if transfer is not None:
+        transfer["done"] = True
+        transfer["wakeup"].set()
+        return transfer["name"], transfer["target"]
+    offer = file_offers.pop(transfer_id, None)
+    if offer is not None:
+        return offer["name"], offer["from"]
+    incoming = incoming_files.pop(transfer_id, None)
+    if incoming is not None:
+        release_part(incoming)
+        try:
+            os.remove(part_path(transfer_id))
+        except OSError:
+            pass
+        return incoming["name"], incoming["from"]
+    return None
+
+def new_file_transfer(peer_key, name):
+    # Runs on the crypto pool: one RSA encryption per file
+    key = Fernet.generate_key()
+    cipher = Fernet(key)
+    return cipher, base64.b64encode(peer_key.encrypt(key, OAEP)).decode('utf-8'), cipher.encrypt(name.encode()).decode()
+
+def read_chunk(f, index, cipher):
+    # Runs on the crypto pool
+    f.seek(index * FILE_CHUNK_BYTES)
+    return cipher.encrypt(CHUNK_INDEX.pack(index) + f.read(FILE_CHUNK_BYTES)).decode()
+
+async def send_file(websocket, target, path):
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        print(f"Error: {e}")
+        return
+    if target not in key_store:
+        keys = await fetch_keys(websocket, [target])
+        if not keys[target]:
+            print(f"Error: Could not retrieve public key for {target}")
+            return
+    # The same file to the same user keeps its id, so a .part the receiver has is reused
+    source = f"{my_username}\0{target}\0{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}"
+    transfer_id = hashlib.sha256(source.encode()).hexdigest()[:32]
+    if transfer_id in outgoing_files:
+        print(f"Already sending {path} to {target}")
+        return
+    name = os.path.basename(path)
+    loop = asyncio.get_running_loop()
+    cipher, encrypted_key, encrypted_name = await loop.run_in_executor(crypto_pool, new_file_transfer, key_store[target], name)
+    transfer = {
+        "target": target, "path": path, "name": name, "size": stat.st_size,
+        "chunks": -(-stat.st_size // FILE_CHUNK_BYTES), "cipher": cipher,
+        "offer": {"action": "file_offer", "target": target, "transfer_id": transfer_id, "name": encrypted_name,
+                  "size": stat.st_size, "chunk_size": FILE_CHUNK_BYTES, "encrypted_key": encrypted_key},
+        "next": 0, "limit": 0, "done": False, "wakeup": asyncio.Event()
+    }
+    outgoing_files[transfer_id] = transfer
+    print(f"[File] Offering {name} ({stat.st_size} bytes) to {target} as {transfer_id[:8]}")
+    await send(websocket, transfer["offer"])
+    try:
+        await stream_file(websocket, transfer_id, transfer)
+    except OSError as e:
+        print(f"[File] {name}: {e}")
+        drop_transfer(transfer_id)
+        await send(websocket, {"action": "file_cancel", "transfer_id": transfer_id, "peer": target})
+
+async def stream_file(websocket, transfer_id, transfer):
+    # Only granted chunks are sent; credit frames move "limit", or rewind "next" on a restart
+    loop = asyncio.get_running_loop()
+    with open(transfer["path"], "rb") as f:
+        while not transfer["done"]:
+            if transfer["next"] >= min(transfer["limit"], transfer["chunks"]):
+                transfer["wakeup"].clear()
+                try:
+                    await asyncio.wait_for(transfer["wakeup"].wait(), FILE_STALL_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # No credit for a while: the receiver may have restarted, so offer again
+                    transfer["next"] = transfer["limit"] = 0
+                    await send(websocket, transfer["offer"])
+                continue
+            index = transfer["next"]
+            transfer["next"] += 1
+            content = await loop.run_in_executor(crypto_pool, read_chunk, f, index, transfer["cipher"])
+            await send(websocket, {"action": "file_chunk", "transfer_id": transfer_id, "index": index, "content": content})
+
+def open_file_offer(data):
+    # Runs on the crypto pool
+    try:
+        cipher = Fernet(MY_PRIVATE_KEY.decrypt(base64.b64decode(data["encrypted_key"]), OAEP))
+        name = cipher.decrypt(data["name"].encode()).decode()
+    except Exception:
+        return None
+    # Only a plain file name is kept, whatever the sender put in it
+    return cipher, re.sub(r"[^A-Za-z0-9_. -]", "_", os.path.basename(name)).lstrip(".") or "file"
+
+async def receive_file_offer(data):
+    transfer_id, sender = data["transfer_id"], data["from"]
+    if not protocol.valid_transfer_id(transfer_id):
+        return f"[File from {sender}]: <Invalid transfer id>", None
+    loop = asyncio.get_running_loop()
+    opened = await loop.run_in_executor(crypto_pool, open_file_offer, data)
+    if opened is None:
+        return f"[File from {sender}]: <Unreadable file key>", {"action": "file_cancel", "transfer_id": transfer_id, "peer": sender}
+    cipher, name = opened
+    incoming = incoming_files.get(transfer_id)
+    if incoming is not None:
+        # Offered again after the sender logged in again: carry on from what is stored
+        incoming["cipher"] = cipher
+        return None, file_credit(transfer_id, incoming, restart=True)
+    offer = {"from": sender, "name": name, "size": data["size"], "chunk_size": data["chunk_size"], "cipher": cipher}
+    if transfer_id in file_offers:
+        file_offers[transfer_id] = offer  # Still waiting for /accept
+        return None, None
+    if os.path.exists(part_path(transfer_id)):
+        return accept_file(transfer_id, offer)
+    file_offers[transfer_id] = offer
+    return f"[File] {sender} offers {name} ({data['size']} bytes), type /accept {transfer_id[:8]}", None
+
+def accept_file(transfer_id, offer):
+    # Whole chunks already in the .part file are kept; the grant asks for the rest
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    path = part_path(transfer_id)
+    f = open(path, "r+b" if os.path.exists(path) else "w+b")
+    chunks = -(-offer["size"] // offer["chunk_size"])
+    stored = min(os.path.getsize(path) // offer["chunk_size"], chunks)
+    f.truncate(stored * offer["chunk_size"])
+    incoming = incoming_files[transfer_id] = dict(
+        offer, file=f, chunks=chunks, next=stored, stored=stored, granted=stored, written=set(), writing=0,
+        progress=time.monotonic(), restarting=False)
+    grant = file_credit(transfer_id, incoming, restart=True)
+    if stored >= chunks:
+        return finish_file(transfer_id), grant
+    verb = "Resuming" if stored else "Receiving"
+    return f"[File] {verb} {offer['name']} from {offer['from']}", grant
+
+def receive_file_chunk(data):
+    transfer_id, index = data["transfer_id"], data["index"]
+    incoming = incoming_files.get(transfer_id)
+    if incoming is None:
+        return
+    if index != incoming["next"]:
+        # One went missing (a full outbox, a dropped connection): ask for the rest, once
+        if index > incoming["next"] and not incoming["restarting"]:
+            incoming["restarting"] = True
+            queue_reply(file_credit(transfer_id, incoming, restart=True))
+        return
+    incoming["restarting"] = False
+    incoming["next"] += 1
+    incoming["progress"] = time.monotonic()
+    # Decrypted and written on the crypto pool, possibly out of order; replies go out in order
+    display_queue.put_nowait(asyncio.ensure_future(store_chunk(transfer_id, incoming, index, data["content"], incoming["cipher"])))
+
+def write_chunk(incoming, index, content, cipher):
+    # Runs on the crypto pool
+    try:
+        plain = cipher.decrypt(content.encode())
+        if CHUNK_INDEX.unpack_from(plain)[0] != index:
+            return False
+        # Positional, so chunks written at once on several threads never move each other's offset
+        os.pwrite(incoming["file"].fileno(), memoryview(plain)[CHUNK_INDEX.size:], index * incoming["chunk_size"])
+        return True
+    except Exception:
+        return False
+
+async def store_chunk(transfer_id, incoming, index, content, cipher):
+    loop = asyncio.get_running_loop()
+    incoming["writing"] += 1
+    try:
+        stored = await loop.run_in_executor(crypto_pool, write_chunk, incoming, index, content, cipher)
+    finally:
+        incoming["writing"] -= 1
+    if incoming_files.get(transfer_id) is not incoming:
+        release_part(incoming)
+        return None, None  # Cancelled or finished meanwhile
+    if not stored:
+        drop_transfer(transfer_id)
+        return (f"[File] {incoming['name']} from {incoming['from']}: chunk {index} is corrupt, cancelled",
+                {"action": "file_cancel", "transfer_id": transfer_id, "peer": incoming["from"]})
+    # Everything below "stored" is on disk, whichever order the writes finished in
+    written = incoming["written"]
+    written.add(index)
+    while incoming["stored"] in written:
+        written.remove(incoming["stored"])
+        incoming["stored"] += 1
+    if incoming["stored"] >= incoming["chunks"]:
+        grant = file_credit(transfer_id, incoming)
+        return finish_file(transfer_id), grant
+    # Credit goes back in batches, keeping up to FILE_WINDOW chunks in flight
+    if incoming["stored"] - incoming["granted"] >= max(1, FILE_WINDOW // 2):
+        return None, file_credit(transfer_id, incoming)
+    return None, None
+
+def release_part(incoming):
+    # The .part file stays open until no write on the crypto pool still uses its descriptor
+    if not incoming["writing"]:
+        incoming["file"].close()
+
+def finish_file(transfer_id):
+    incoming = incoming_files.pop(transfer_id)
+    release_part(incoming)
+    base, extension = os.path.splitext(incoming["name"])
+    path = os.path.join(DOWNLOAD_DIR, incoming["name"])
+    copy = 1
+    while os.path.exists(path):
+        path = os.path.join(DOWNLOAD_DIR, f"{base} ({copy}){extension}")
+        copy += 1
+    os.replace(part_path(transfer_id), path)
+    return f"[File] Received {incoming['name']} from {incoming['from']}: {path}"
+
+async def accept_offer(websocket, prefix):
+    transfer_id = find_transfer(prefix, file_offers)
+    if transfer_id is None:
+        print(f"No file offer {prefix}")
+        return
+    text, grant = accept_file(transfer_id, file_offers.pop(transfer_id))
+    print(text)
+    await send(websocket, grant)
+
+async def cancel_transfer(websocket, prefix):
+    transfer_id = find_transfer(prefix, outgoing_files, incoming_files, file_offers)
+    if transfer_id is None:
+        print(f"No file transfer {prefix}")
+        return
+    name, peer = drop_transfer(transfer_id)
+    print(f"[File] Cancelled {name}")
+    await send(websocket, {"action": "file_cancel", "transfer_id": transfer_id, "peer": peer})
+
+async def watch_transfers(websocket):
+    # A transfer with no progress (a lost grant, a peer that came back) is asked again
+    while True:
+        await asyncio.sleep(FILE_STALL_TIMEOUT)
+        now = time.monotonic()
+        for transfer_id, incoming in list(incoming_files.items()):
+            if now - incoming["progress"] >= FILE_STALL_TIMEOUT:
+                incoming["progress"] = now
+                await send(websocket, file_credit(transfer_id, incoming, restart=True))
+
+async def print_messages(websocket):
+    while True:
+        text, reply = await (await display_queue.get())
+        if text:
+            print(f"\n{text}")
+        if reply:
+            await send(websocket, reply)
+
+class Connection:
+    """The link to the server; sends wait while a dropped socket is being resumed."""
+
+    def __init__(self):
+        self.websocket = None
+        self.connected = asyncio.Event()
+        self.closing = False
+
+    def attach(self, websocket):
+        self.websocket = websocket
+        self.connected.set()
+
+    async def send(self, data):
+        while not self.closing:
+            await self.connected.wait()
+            try:
+                return await self.websocket.send(data)
+            except websockets.exceptions.ConnectionClosed:
+                self.connected.clear()
+
+    async def close(self):
+        # Ack what has arrived, so a clean logout leaves the server nothing to resend
+        if self.connected.is_set():
+            await send_ack(self)
+        self.closing = True
+        if self.websocket:
+            await self.websocket.close()
+
+def note_seq(connection, seq):
+    # Acks are cumulative, so one covers everything up to last_seq
+    global last_seq, ack_timer
+    last_seq = seq
+    if last_seq - acked_seq >= ACK_EVERY:
+        asyncio.create_task(send_ack(connection))
+    elif ack_timer is None:
+        ack_timer = asyncio.get_running_loop().call_later(ACK_DELAY, lambda: asyncio.create_task(send_ack(connection)))
+
+async def send_ack(connection):
+    global acked_seq, ack_timer
+    if ack_timer:
+        ack_timer.cancel()
+        ack_timer = None
+    if last_seq > acked_seq:
+        acked_seq = last_seq
+        await send(connection, {"action": "ack", "seq": last_seq})
+
+async def listen(connection, websocket):
     try:
         async for message in websocket:
-            data = json.loads(message)
-            
-            if "status" in data:
-                print(f"[Server] {data['message']}")
-                # If server advertises a default model, show it
-                default_model = data.get("default_model")
-                if default_model:
-                    print(f"[Server] Default model: {default_model}")
-            
-            elif "type" in data:
-                msg_type = data["type"]
-
-                if msg_type == "pub_key":
-                    # Received a requested public key
-                    username = data["username"]
-                    pem = data["key"]
-                    pub_key = serialization.load_pem_public_key(pem.encode('utf-8'))
-                    key_store[username] = pub_key
-                    if username in key_events:
-                        key_events[username].set() # Wake up sender
-                
-                elif msg_type == "private":
-                    sender = data['from']
-                    try:
-                        # 1. Decrypt Fernet Key with My Private Key
-                        encrypted_key_b64 = data.get('encrypted_key')
-                        if not encrypted_key_b64:
-                            print(f"\n[Private from {sender}]: <Missing Key>")
-                            continue
-                        
-                        encrypted_key = base64.b64decode(encrypted_key_b64)
-                        
-                        fernet_key = MY_PRIVATE_KEY.decrypt(
-                            encrypted_key,
-                            padding.OAEP(
-                                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                                algorithm=hashes.SHA256(),
-                                label=None
-                            )
-                        )
-                        
-                        # 2. Decrypt Content using Fernet Key
-                        temp_cipher = Fernet(fernet_key)
-                        encrypted_content = data['content']
-                        decrypted_content = temp_cipher.decrypt(encrypted_content.encode()).decode()
-                        print(f"\n[Private from {sender}]: {decrypted_content}")
-                        
-                    except Exception as e:
-                        print(f"\n[Private from {sender}]: <Decryption Error: {e}>")
-
-                elif msg_type == "group":
-                    # Fallback to shared key for groups
-                    try:
-                        encrypted_content = data['content']
-                        decrypted_content = group_cipher.decrypt(encrypted_content.encode()).decode()
-                        print(f"\n[Group {data['group']} - {data['from']}]: {decrypted_content}")
-                    except Exception as e:
-                         print(f"\n[Group {data['group']} - {data['from']}]: <Decryption Error: {e}>")
+            _, data = protocol.decode(message)
+            seq = data.get("seq")
+            if seq:
+                if seq <= last_seq:
+                    continue  # Resent after a resume, but it had already arrived
+                note_seq(connection, seq)
+            if data.get("type") == "batch":
+                # Messages that were queued while we were offline
+                for frame in data["frames"]:
+                    handle_message(frame)
+            else:
+                handle_message(data)
 
     except websockets.exceptions.ConnectionClosed:
-        print("\nDisconnected from server.")
-        sys.exit(0)
+        pass
 
 def handle_input(loop, websocket):
-    print("Commands: /msg <user> <text>, /join <group>, /group <group> <text>, /quit")
+    print("Commands: /msg <user> <text>, /join <group>, /group <group> <text>, /history <group>, /who,")
+    print("          /send <user> <path>, /accept <id>, /cancel <id>, /quit")
     while True:
         try:
             text = input()
@@ -130,20 +853,49 @@ def handle_input(loop, websocket):
                 if len(parts) >= 2:
                     group = parts[1]
                     msg = {"action": "join_group", "group": group}
-                    asyncio.run_coroutine_threadsafe(websocket.send(json.dumps(msg)), loop)
+                    asyncio.run_coroutine_threadsafe(send(websocket, msg), loop)
                 else:
                     print("Usage: /join <group>")
 
+            elif text.startswith("/send"):
+                parts = text.split(" ", 2)
+                if len(parts) >= 3:
+                    asyncio.run_coroutine_threadsafe(send_file(websocket, parts[1], os.path.expanduser(parts[2])), loop)
+                else:
+                    print("Usage: /send <user> <path>")
+
+            elif text.startswith("/accept"):
+                parts = text.split(" ", 1)
+                if len(parts) >= 2:
+                    asyncio.run_coroutine_threadsafe(accept_offer(websocket, parts[1].strip()), loop)
+                else:
+                    print("Usage: /accept <id>")
+
+            elif text.startswith("/cancel"):
+                parts = text.split(" ", 1)
+                if len(parts) >= 2:
+                    asyncio.run_coroutine_threadsafe(cancel_transfer(websocket, parts[1].strip()), loop)
+                else:
+                    print("Usage: /cancel <id>")
+
+            elif text.startswith("/who"):
+                print(f"Online: {', '.join(sorted(online_users)) or 'nobody'}")
+
+            elif text.startswith("/history"):
+                parts = text.split(" ", 1)
+                if len(parts) >= 2:
+                    msg = {"action": "history", "group": parts[1]}
+                    asyncio.run_coroutine_threadsafe(send(websocket, msg), loop)
+                else:
+                    print("Usage: /history <group>")
+
             elif text.startswith("/group"):
                 parts = text.split(" ", 2)
                 if len(parts) >= 3:
                     group = parts[1]
                     content = parts[2]
-                    # Encrypt content with shared group key
-                    encrypted_content = group_cipher.encrypt(content.encode()).decode()
-                    
-                    msg = {"action": "group", "group": group, "content": encrypted_content}
-                    asyncio.run_coroutine_threadsafe(websocket.send(json.dumps(msg)), loop)
+                    # Encrypted with my sender key for the group
+                    asyncio.run_coroutine_threadsafe(send_group_message(websocket, group, content), loop)
                 else:
                     print("Usage: /group <group> <text>")
 
@@ -156,66 +908,116 @@ async def send_private_message(websocket, target, content):
     # 1. Check if we have the key
     if target not in key_store:
         print(f"Fetching public key for {target}...")
-        key_events[target] = asyncio.Event()
-        await websocket.send(json.dumps({"action": "get_key", "target": target}))
-        
-        try:
-            # Wait for key response (timeout 5s)
-            await asyncio.wait_for(key_events[target].wait(), timeout=5.0)
-            del key_events[target]
-        except asyncio.TimeoutError:
+        keys = await fetch_keys(websocket, [target])
+        if not keys[target]:
             print(f"Error: Could not retrieve public key for {target}")
             return # Abort
 
-    # 2. Generate a One-Time Session Key (Fernet)
-    session_key = Fernet.generate_key()
-    session_cipher = Fernet(session_key)
-    
+    # 2. Reuse (or create) the session key for this peer
+    session = await get_outgoing_session(target)
+
     # 3. Encrypt Content with Session Key
-    encrypted_content = session_cipher.encrypt(content.encode()).decode()
-    
-    # 4. Encrypt Session Key with Target's RSA Key
-    target_pub_key = key_store[target]
-    encrypted_key = target_pub_key.encrypt(
-        session_key,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
-    # Base64 encode the binary encrypted key to send via JSON
-    encrypted_key_b64 = base64.b64encode(encrypted_key).decode('utf-8')
-    
-    # 5. Send
+    encrypted_content = session["cipher"].encrypt(content.encode()).decode()
+
+    # 4. Send; the RSA-wrapped session key only rides along on the session's first message
     msg = {
         "action": "private", 
         "target": target, 
         "content": encrypted_content,
-        "encrypted_key": encrypted_key_b64
+        "key_id": session["id"]
+    }
+    if session["sent"] == 0:
+        msg["encrypted_key"] = session["encrypted_key"]
+    session["sent"] += 1
+    await send(websocket, msg)
+
+def new_outgoing_session(peer_key):
+    # Runs on the crypto pool: the only RSA operation a sender performs per session
+    session_key = Fernet.generate_key()
+    encrypted_key = peer_key.encrypt(session_key, OAEP)
+    return {
+        "id": os.urandom(8).hex(),
+        "cipher": Fernet(session_key),
+        # Base64 encode the binary encrypted key to send via JSON
+        "encrypted_key": base64.b64encode(encrypted_key).decode('utf-8'),
+        "created": time.monotonic(),
+        "sent": 0
     }
-    await websocket.send(json.dumps(msg))
+
+async def get_outgoing_session(target):
+    lock = session_locks.setdefault(target, asyncio.Lock())
+    async with lock:
+        session = outgoing_sessions.get(target)
+        # Rotate on age, message count, or when the peer's identity key changed
+        if (session is None
+                or session["fingerprint"] != known_fingerprints.get(target)
+                or time.monotonic() - session["created"] > SESSION_MAX_AGE
+                or session["sent"] >= SESSION_MAX_MESSAGES):
+            loop = asyncio.get_running_loop()
+            session = await loop.run_in_executor(crypto_pool, new_outgoing_session, key_store[target])
+            session["fingerprint"] = known_fingerprints.get(target)
+            outgoing_sessions[target] = session
+        return session
 
 
 async def start_client():
-    generate_keys()
+    global my_username
+    load_known_keys()
     
     uri = "ws://localhost:8765"
-    async with websockets.connect(uri) as websocket:
-        username = input("Enter your username: ")
-        # Send Public Key on Login
-        await websocket.send(json.dumps({
-            "action": "login", 
-            "username": username,
-            "public_key": MY_PUBLIC_PEM
-        }))
-        
-        loop = asyncio.get_running_loop()
-        input_thread = threading.Thread(target=handle_input, args=(loop, websocket))
-        input_thread.daemon = True
-        input_thread.start()
-        
-        await listen(websocket)
+    username = my_username = input("Enter your username: ")
+    load_identity(username)
+    connection = Connection()
+    printer = asyncio.create_task(print_messages(connection))
+    watcher = asyncio.create_task(watch_transfers(connection))
+
+    loop = asyncio.get_running_loop()
+    input_thread = threading.Thread(target=handle_input, args=(loop, connection))
+    input_thread.daemon = True
+    input_thread.start()
+
+    while not connection.closing:
+        try:
+            # Binary frames carry raw ciphertext that deflate cannot shrink, so skip it
+            websocket = await websockets.connect(uri, compression=None if protocol.BINARY else "deflate")
+        except OSError as e:
+            if connection.websocket is None:
+                raise
+            print(f"Reconnect failed ({e}), retrying in {RECONNECT_DELAY:.0f}s...")
+            await asyncio.sleep(RECONNECT_DELAY)
+            continue
+
+        if resume_token:
+            # Same session, no key exchange; the server resends what we have not acked
+            await websocket.send(codec.encode({
+                "action": "resume",
+                "username": username,
+                "token": resume_token,
+                "last_seq": last_seq,
+                "protocols": protocol.available()
+            }))
+        else:
+            # Send Public Key on Login
+            await websocket.send(codec.encode({
+                "action": "login",
+                "username": username,
+                "public_key": MY_PUBLIC_PEM,
+                # Codecs we can speak, most compact first; the server picks one
+                "protocols": protocol.available(),
+                "reliable": True
+            }))
+            # Revalidate every cached contact key in a single exchange
+            if known_fingerprints:
+                asyncio.create_task(fetch_keys(connection, list(known_fingerprints)))
+        connection.attach(websocket)
+
+        await listen(connection, websocket)
+        connection.connected.clear()
+        if not connection.closing:
+            print("\nConnection lost, resuming session...")
+    printer.cancel()
+    watcher.cancel()
+    print("\nDisconnected from server.")
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,108 @@
+import threading
+
+# In-memory engine, selected with DATABASE_URL=memory://. Nothing survives a restart.
+
+# Everything is behind one lock, so extra executor threads would only wait on it
+MAX_CONCURRENCY = 1
+
+_lock = threading.Lock()  # Calls arrive on the database executor's thread
+_users = {}  # {username: public_key}
+_groups = {}  # {group_name: set of usernames}
+_last_seen = {}  # {username: wall-clock time}
+
+
+def connect(url):
+    pass
+
+
+def close():
+    with _lock:
+        _users.clear()
+        _groups.clear()
+        _last_seen.clear()
+
+
+def init_db():
+    print("Database initialized successfully (in-memory).")
+    return True
+
+
+def add_user(username, public_key):
+    with _lock:
+        _users[username] = public_key
+
+
+def get_all_users():
+    with _lock:
+        return dict(_users)
+
+
+def get_user_key(username):
+    with _lock:
+        return _users.get(username)
+
+
+def get_user_keys(usernames):
+    with _lock:
+        return {username: _users[username] for username in usernames if username in _users}
+
+
+def add_to_group(username, group_name):
+    with _lock:
+        if username in _users:
+            _groups.setdefault(group_name, set()).add(username)
+
+
+def remove_user_from_group(username, group_name):
+    with _lock:
+        _groups.get(group_name, set()).discard(username)
+
+
+def get_group_members(group_name):
+    with _lock:
+        return set(_groups.get(group_name, ()))
+
+
+def get_user_groups(username):
+    with _lock:
+        return {group_name for group_name, members in _groups.items() if username in members}
+
+
+def get_all_groups():
+    with _lock:
+        return {group_name: set(members) for group_name, members in _groups.items() if members}
+
+
+def get_last_seen(username):
+    with _lock:
+        return _last_seen.get(username)
+
+
+def add_users(rows):
+    with _lock:
+        _users.update(rows)
+    return True
+
+
+def add_to_groups(rows):
+    with _lock:
+        for group_name, username in rows:
+            # Same rule as the Postgres foreign key
+            if username in _users:
+                _groups.setdefault(group_name, set()).add(username)
+    return True
+
+
+def remove_users_from_groups(rows):
+    with _lock:
+        for group_name, username in rows:
+            _groups.get(group_name, set()).discard(username)
+    return True
+
+
+def set_last_seen(rows):
+    with _lock:
+        for username, seen_at in rows:
+            # Only ever moves forward, whichever worker's batch lands first
+            _last_seen[username] = max(seen_at, _last_seen.get(username, seen_at))
+    return True
@@ -0,0 +1,375 @@
+import os
+import threading
+import time
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+import metrics
+
+# PostgreSQL engine, selected with DATABASE_URL=postgresql://...
+
+# Connection pool settings
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# Seconds to wait for a free connection before giving up
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "5"))
+# Connections idle for longer than this are pinged before being handed out
+DB_HEALTHCHECK_INTERVAL = float(os.getenv("DB_HEALTHCHECK_INTERVAL", "30"))
+
+# One executor thread per pooled connection
+MAX_CONCURRENCY = DB_POOL_MAX
+
+_dsn = None
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_last_used = {}  # {id(conn): monotonic timestamp}
+
+DB_ACQUIRE_SECONDS = metrics.Histogram("chat_db_acquire_seconds", "Time spent waiting for a pooled connection.")
+DB_CONNECT_FAILURES = metrics.Counter("chat_db_connect_failures_total", "Pooled connections that could not be handed out.")
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, _dsn)
+        return _pool
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    last_used = _last_used.get(id(conn))
+    # Fresh connections were just opened, so they are known to be good
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+def get_connection():
+    started = time.perf_counter()
+    acquired = _slots.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    DB_ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+    if not acquired:
+        DB_CONNECT_FAILURES.inc()
+        print(f"Error connecting to database: no free connection after {DB_ACQUIRE_TIMEOUT}s")
+        return None
+    try:
+        pool = _get_pool()
+        conn = pool.getconn()
+        if not _is_healthy(conn):
+            _last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        return conn
+    except Exception as e:
+        _slots.release()
+        DB_CONNECT_FAILURES.inc()
+        print(f"Error connecting to database: {e}")
+        return None
+
+def release_connection(conn):
+    try:
+        if not conn.closed:
+            # Never hand out a connection with a half-finished transaction
+            try:
+                conn.rollback()
+            except Exception:
+                conn.close()
+        if conn.closed:
+            _last_used.pop(id(conn), None)
+        else:
+            _last_used[id(conn)] = time.monotonic()
+        _get_pool().putconn(conn, close=bool(conn.closed))
+    finally:
+        _slots.release()
+
+def connect(url):
+    # Connections are opened lazily; an empty url means libpq's defaults (PGHOST etc.)
+    global _dsn
+    _dsn = url
+
+def close():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+def init_db():
+    conn = get_connection()
+    if not conn:
+        return False
+
+    try:
+        with conn.cursor() as cur:
+            # Users table
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    username TEXT PRIMARY KEY,
+                    public_key TEXT
+                );
+            """)
+            
+            # Group memberships table
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS group_members (
+                    group_name TEXT,
+                    username TEXT,
+                    PRIMARY KEY (group_name, username),
+                    FOREIGN KEY (username) REFERENCES users(username)
+                );
+            """)
+            # Looked up at login to build the online-member index
+            cur.execute("CREATE INDEX IF NOT EXISTS group_members_username ON group_members (username);")
+            # When each user was last connected; no foreign key, web clients may never register a key
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS last_seen (
+                    username TEXT PRIMARY KEY,
+                    seen_at DOUBLE PRECISION
+                );
+            """)
+            conn.commit()
+            print("Database initialized successfully.")
+            return True
+    except Exception as e:
+        print(f"Error initializing database: {e}")
+        return False
+    finally:
+        release_connection(conn)
+
+def add_user(username, public_key):
+    conn = get_connection()
+    if not conn: return
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (username, public_key)
+                VALUES (%s, %s)
+                ON CONFLICT (username) DO UPDATE 
+                SET public_key = EXCLUDED.public_key;
+            """, (username, public_key))
+        conn.commit()
+    except Exception as e:
+        print(f"Error adding user {username}: {e}")
+    finally:
+        release_connection(conn)
+
+def get_all_users():
+    conn = get_connection()
+    if not conn: return {}
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT username, public_key FROM users;")
+            rows = cur.fetchall()
+            return {row[0]: row[1] for row in rows}
+    except Exception as e:
+        print(f"Error fetching users: {e}")
+        return {}
+    finally:
+        release_connection(conn)
+
+def get_user_key(username):
+    conn = get_connection()
+    if not conn: return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT public_key FROM users WHERE username = %s;", (username,))
+            row = cur.fetchone()
+            return row[0] if row else None
+    except Exception as e:
+        print(f"Error fetching user {username}: {e}")
+        return None
+    finally:
+        release_connection(conn)
+
+def get_user_keys(usernames):
+    conn = get_connection()
+    if not conn: return {}
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT username, public_key FROM users WHERE username = ANY(%s);", (list(usernames),))
+            return {row[0]: row[1] for row in cur.fetchall()}
+    except Exception as e:
+        print(f"Error fetching {len(usernames)} users: {e}")
+        return {}
+    finally:
+        release_connection(conn)
+
+def add_to_group(username, group_name):
+    conn = get_connection()
+    if not conn: return
+    try:
+        with conn.cursor() as cur:
+            # Ensure user exists first (FK constraint)
+            # In a real app we might want to ensure they are registered, but 
+            # our logic calls add_user on login so strict FK is fine.
+            cur.execute("""
+                INSERT INTO group_members (group_name, username)
+                VALUES (%s, %s)
+                ON CONFLICT DO NOTHING;
+            """, (group_name, username))
+        conn.commit()
+    except Exception as e:
+        print(f"Error adding {username} to group {group_name}: {e}")
+    finally:
+        release_connection(conn)
+
+def remove_user_from_group(username, group_name):
+    conn = get_connection()
+    if not conn: return
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM group_members
+                WHERE group_name = %s AND username = %s;
+            """, (group_name, username))
+        conn.commit()
+    except Exception as e:
+        print(f"Error removing {username} from group {group_name}: {e}")
+    finally:
+        release_connection(conn)
+
+def get_group_members(group_name):
+    conn = get_connection()
+    if not conn: return set()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT username FROM group_members WHERE group_name = %s;", (group_name,))
+            return {row[0] for row in cur.fetchall()}
+    except Exception as e:
+        print(f"Error fetching members of group {group_name}: {e}")
+        return set()
+    finally:
+        release_connection(conn)
+
+def get_user_groups(username):
+    conn = get_connection()
+    if not conn: return set()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT group_name FROM group_members WHERE username = %s;", (username,))
+            return {row[0] for row in cur.fetchall()}
+    except Exception as e:
+        print(f"Error fetching groups of {username}: {e}")
+        return set()
+    finally:
+        release_connection(conn)
+
+def get_all_groups():
+    conn = get_connection()
+    if not conn: return {}
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT group_name, username FROM group_members;")
+            rows = cur.fetchall()
+            
+            groups = {}
+            for group_name, username in rows:
+                if group_name not in groups:
+                    groups[group_name] = set()
+                groups[group_name].add(username)
+            return groups
+    except Exception as e:
+        print(f"Error fetching groups: {e}")
+        return {}
+    finally:
+        release_connection(conn)
+
+def get_last_seen(username):
+    conn = get_connection()
+    if not conn: return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT seen_at FROM last_seen WHERE username = %s;", (username,))
+            row = cur.fetchone()
+            return row[0] if row else None
+    except Exception as e:
+        print(f"Error fetching last seen time of {username}: {e}")
+        return None
+    finally:
+        release_connection(conn)
+
+# Bulk variants used by the write-behind stage: one statement per batch.
+# They return True on success so failed batches can be retried.
+def add_users(rows):
+    conn = get_connection()
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO users (username, public_key)
+                VALUES %s
+                ON CONFLICT (username) DO UPDATE
+                SET public_key = EXCLUDED.public_key;
+            """, rows, page_size=len(rows))
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Error adding {len(rows)} users: {e}")
+        return False
+    finally:
+        release_connection(conn)
+
+def add_to_groups(rows):
+    conn = get_connection()
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            # Rows for users without a users row (e.g. web clients that never sent
+            # a key) are skipped instead of failing the whole batch on the FK.
+            execute_values(cur, """
+                INSERT INTO group_members (group_name, username)
+                SELECT v.group_name, v.username
+                FROM (VALUES %s) AS v (group_name, username)
+                JOIN users u ON u.username = v.username
+                ON CONFLICT DO NOTHING;
+            """, rows, page_size=len(rows))
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Error adding {len(rows)} group memberships: {e}")
+        return False
+    finally:
+        release_connection(conn)
+
+def remove_users_from_groups(rows):
+    conn = get_connection()
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            execute_values(cur, """
+                DELETE FROM group_members
+                WHERE (group_name, username) IN (VALUES %s);
+            """, rows, page_size=len(rows))
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Error removing {len(rows)} group memberships: {e}")
+        return False
+    finally:
+        release_connection(conn)
+
+def set_last_seen(rows):
+    conn = get_connection()
+    if not conn: return False
+    try:
+        with conn.cursor() as cur:
+            # Only ever moves forward, whichever worker's batch lands first
+            execute_values(cur, """
+                INSERT INTO last_seen (username, seen_at)
+                VALUES %s
+                ON CONFLICT (username) DO UPDATE
+                SET seen_at = GREATEST(last_seen.seen_at, EXCLUDED.seen_at);
+            """, rows, page_size=len(rows))
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Error saving {len(rows)} last seen times: {e}")
+        return False
+    finally:
+        release_connection(conn)
@@ -0,0 +1,251 @@
+import json
+import os
+import sqlite3
+import threading
+
+# Embedded SQLite engine, selected with DATABASE_URL=sqlite:///path/to/chat.db
+# (four slashes for an absolute path). WAL mode lets readers on other executor
+# threads, or other worker processes, proceed while a batch is being written.
+
+# Executor threads, each with its own connection
+SQLITE_THREADS = int(os.getenv("SQLITE_THREADS", "4"))
+# Milliseconds a writer waits for another process's transaction before failing
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+# synchronous=NORMAL is durable across crashes of this process in WAL mode, and
+# skips an fsync per commit; set FULL to survive power loss as well
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+
+MAX_CONCURRENCY = SQLITE_THREADS
+
+_path = None
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0  # Bumped by close() so threads reopen instead of reusing closed connections
+
+# Statements are constant strings, so sqlite3's per-connection statement cache
+# prepares each one once and reuses it for every later call
+UPSERT_USER = """
+    INSERT INTO users (username, public_key) VALUES (?, ?)
+    ON CONFLICT (username) DO UPDATE SET public_key = excluded.public_key
+"""
+SELECT_USERS = "SELECT username, public_key FROM users"
+SELECT_USER_KEY = "SELECT public_key FROM users WHERE username = ?"
+# One bound parameter for any number of names, instead of one per name
+SELECT_USER_KEYS = "SELECT username, public_key FROM users WHERE username IN (SELECT value FROM json_each(?))"
+INSERT_MEMBER = "INSERT OR IGNORE INTO group_members (group_name, username) VALUES (?, ?)"
+# Members without a users row are skipped, like the Postgres bulk insert
+INSERT_MEMBER_IF_USER = """
+    INSERT OR IGNORE INTO group_members (group_name, username)
+    SELECT ?, username FROM users WHERE username = ?
+"""
+DELETE_MEMBER = "DELETE FROM group_members WHERE group_name = ? AND username = ?"
+SELECT_MEMBERS = "SELECT username FROM group_members WHERE group_name = ?"
+SELECT_USER_GROUPS = "SELECT group_name FROM group_members WHERE username = ?"
+SELECT_ALL_MEMBERS = "SELECT group_name, username FROM group_members"
+# Only ever moves forward, whichever worker's batch lands first
+UPSERT_LAST_SEEN = """
+    INSERT INTO last_seen (username, seen_at) VALUES (?, ?)
+    ON CONFLICT (username) DO UPDATE SET seen_at = max(seen_at, excluded.seen_at)
+"""
+SELECT_LAST_SEEN = "SELECT seen_at FROM last_seen WHERE username = ?"
+
+
+def connect(url):
+    global _path
+    _path = url[len("sqlite:///"):] if url.startswith("sqlite:///") else url[len("sqlite:"):]
+    if not _path:
+        raise ValueError("sqlite DATABASE_URL needs a file path, e.g. sqlite:///data/chat.db")
+
+
+def _connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.generation != _generation:
+        directory = os.path.dirname(_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Autocommit mode: transactions are opened explicitly around each batch
+        conn = sqlite3.connect(_path, isolation_level=None, check_same_thread=False, cached_statements=64)
+        conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT}")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+        conn.execute("PRAGMA foreign_keys = ON")
+        _local.conn = conn
+        _local.generation = _generation
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+def _write(statement, rows):
+    # Every row in one transaction: one commit (and WAL sync) per batch
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(statement, rows)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def close():
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+
+
+def init_db():
+    try:
+        conn = _connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                public_key TEXT
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS group_members (
+                group_name TEXT,
+                username TEXT,
+                PRIMARY KEY (group_name, username),
+                FOREIGN KEY (username) REFERENCES users(username)
+            )
+        """)
+        # Looked up at login to build the online-member index
+        conn.execute("CREATE INDEX IF NOT EXISTS group_members_username ON group_members (username)")
+        # When each user was last connected; no foreign key, web clients may never register a key
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS last_seen (
+                username TEXT PRIMARY KEY,
+                seen_at REAL
+            )
+        """)
+        print(f"Database initialized successfully ({_path}).")
+        return True
+    except sqlite3.Error as e:
+        print(f"Error initializing database: {e}")
+        return False
+
+
+def add_user(username, public_key):
+    try:
+        _write(UPSERT_USER, [(username, public_key)])
+    except sqlite3.Error as e:
+        print(f"Error adding user {username}: {e}")
+
+
+def get_all_users():
+    try:
+        return dict(_connection().execute(SELECT_USERS).fetchall())
+    except sqlite3.Error as e:
+        print(f"Error fetching users: {e}")
+        return {}
+
+
+def get_user_key(username):
+    try:
+        row = _connection().execute(SELECT_USER_KEY, (username,)).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error as e:
+        print(f"Error fetching user {username}: {e}")
+        return None
+
+
+def get_user_keys(usernames):
+    try:
+        return dict(_connection().execute(SELECT_USER_KEYS, (json.dumps(list(usernames)),)).fetchall())
+    except sqlite3.Error as e:
+        print(f"Error fetching {len(usernames)} users: {e}")
+        return {}
+
+
+def add_to_group(username, group_name):
+    try:
+        _write(INSERT_MEMBER, [(group_name, username)])
+    except sqlite3.Error as e:
+        print(f"Error adding {username} to group {group_name}: {e}")
+
+
+def remove_user_from_group(username, group_name):
+    try:
+        _write(DELETE_MEMBER, [(group_name, username)])
+    except sqlite3.Error as e:
+        print(f"Error removing {username} from group {group_name}: {e}")
+
+
+def get_group_members(group_name):
+    try:
+        return {row[0] for row in _connection().execute(SELECT_MEMBERS, (group_name,))}
+    except sqlite3.Error as e:
+        print(f"Error fetching members of group {group_name}: {e}")
+        return set()
+
+
+def get_user_groups(username):
+    try:
+        return {row[0] for row in _connection().execute(SELECT_USER_GROUPS, (username,))}
+    except sqlite3.Error as e:
+        print(f"Error fetching groups of {username}: {e}")
+        return set()
+
+
+def get_all_groups():
+    try:
+        groups = {}
+        for group_name, username in _connection().execute(SELECT_ALL_MEMBERS):
+            groups.setdefault(group_name, set()).add(username)
+        return groups
+    except sqlite3.Error as e:
+        print(f"Error fetching groups: {e}")
+        return {}
+
+
+def get_last_seen(username):
+    try:
+        row = _connection().execute(SELECT_LAST_SEEN, (username,)).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error as e:
+        print(f"Error fetching last seen time of {username}: {e}")
+        return None
+
+
+# Bulk variants used by the write-behind stage: one transaction per batch.
+# They return True on success so failed batches can be retried.
+def add_users(rows):
+    try:
+        _write(UPSERT_USER, rows)
+        return True
+    except sqlite3.Error as e:
+        print(f"Error adding {len(rows)} users: {e}")
+        return False
+
+
+def add_to_groups(rows):
+    try:
+        _write(INSERT_MEMBER_IF_USER, rows)
+        return True
+    except sqlite3.Error as e:
+        print(f"Error adding {len(rows)} group memberships: {e}")
+        return False
+
+
+def remove_users_from_groups(rows):
+    try:
+        _write(DELETE_MEMBER, rows)
+        return True
+    except sqlite3.Error as e:
+        print(f"Error removing {len(rows)} group memberships: {e}")
+        return False
+
+
+def set_last_seen(rows):
+    try:
+        _write(UPSERT_LAST_SEEN, rows)
+        return True
+    except sqlite3.Error as e:
+        print(f"Error saving {len(rows)} last seen times: {e}")
+        return False
@@ -0,0 +1,210 @@
+import asyncio
+import io
+import os
+import secrets
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from http import HTTPStatus
+
+import metrics
+
+# Seconds between event-loop lag probes
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.1"))
+# A loop blocked longer than this is logged with the stack that blocked it
+SLOW_CALLBACK_SECONDS = float(os.environ.get("SLOW_CALLBACK_SECONDS", "0.1"))
+# Handlers slower than this (wall time, awaits included) go in the slow-handler ring
+SLOW_HANDLER_SECONDS = float(os.environ.get("SLOW_HANDLER_SECONDS", "0.05"))
+SLOW_HANDLER_BUFFER = int(os.environ.get("SLOW_HANDLER_BUFFER", "100"))
+# A dump samples the event-loop thread this often, for this long
+PROFILE_HZ = float(os.environ.get("PROFILE_HZ", "100"))
+PROFILE_SECONDS = float(os.environ.get("PROFILE_SECONDS", "10"))
+DUMP_DIR = os.environ.get("DUMP_DIR", "data/dumps")
+# Bearer token for GET /debug/profile; unset disables the endpoint
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+STACK_DEPTH = 12  # Frames kept per stalled stack and per task in a dump
+
+LOOP_LAG = metrics.Histogram("chat_loop_lag_seconds", "How late the event loop ran a timer.")
+LOOP_STALLS = metrics.Counter("chat_loop_stalls_total", "Times the event loop was blocked longer than SLOW_CALLBACK_SECONDS.")
+SLOW_HANDLERS = metrics.Counter("chat_slow_handlers_total", "Handlers slower than SLOW_HANDLER_SECONDS, by action.", ("action",))
+DUMPS = metrics.Counter("chat_diagnostic_dumps_total", "Profile and task dumps written.")
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def stack_of(frame, limit=None):
+    # Innermost first
+    labels = []
+    while frame is not None and (limit is None or len(labels) < limit):
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return labels
+
+
+class Watchdog:
+    """Event-loop lag, stalls, slow handlers and on-demand profiles for one worker.
+
+    Always on: a timer task measures loop lag and a thread looks at the loop
+    thread's stack only when that timer is overdue, so a stall is caught while
+    the blocking code is still running. The task running at the time is named
+    after the action and user it is handling (see dispatch in server.py).
+    Profiling costs nothing until a dump is asked for with SIGUSR1 or
+    GET /debug/profile.
+    """
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL, slow_callback=SLOW_CALLBACK_SECONDS,
+                 slow_handler=SLOW_HANDLER_SECONDS, buffer=SLOW_HANDLER_BUFFER):
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.slow_handler = slow_handler
+        self.slow = deque(maxlen=buffer)  # (wall clock, kind, what, user, seconds), most recent last
+        self._loop = None
+        self._loop_thread = None
+        self._heartbeat = time.monotonic()
+        self._stall = None  # (task name, stack) seen by the thread during the current stall
+        self._profiling = False
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        try:
+            self._loop.add_signal_handler(signal.SIGUSR1, self.dump)
+        except (NotImplementedError, RuntimeError):
+            pass  # No signals here; the HTTP endpoint still works
+        self._task = asyncio.create_task(self._run(), name="watchdog")
+        self._thread = threading.Thread(target=self._watch, name="watchdog", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self):
+        loop = self._loop
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self._heartbeat = time.monotonic()
+            LOOP_LAG.observe(lag)
+            if lag >= self.slow_callback:
+                self._report_stall(lag)
+
+    def _report_stall(self, lag):
+        LOOP_STALLS.inc()
+        stall, self._stall = self._stall, None
+        if stall is None:
+            # Over before the thread looked; only the lag is known
+            print(f"Event loop blocked for {lag * 1000:.0f} ms")
+            self.slow.append((time.time(), "stall", "unknown", None, lag))
+            return
+        task_name, stack = stall
+        print(f"Event loop blocked for {lag * 1000:.0f} ms in {task_name}:\n  " + "\n  ".join(stack))
+        self.slow.append((time.time(), "stall", f"{task_name} at {stack[0] if stack else '?'}", None, lag))
+
+    def _watch(self):
+        # Runs on its own thread, so it can look at the loop while the loop is stuck
+        seen = None
+        while not self._stopped.wait(self.slow_callback / 2):
+            heartbeat = self._heartbeat
+            overdue = time.monotonic() - heartbeat - self.interval
+            if overdue < self.slow_callback or seen == heartbeat:
+                continue
+            seen = heartbeat  # One capture per stall
+            frame = sys._current_frames().get(self._loop_thread)
+            task = asyncio.current_task(self._loop)
+            self._stall = (task.get_name() if task else "a callback", stack_of(frame, STACK_DEPTH))
+
+    def handled(self, action, username, seconds):
+        # Called by dispatch for every handler; one comparison unless it was slow
+        if seconds >= self.slow_handler:
+            SLOW_HANDLERS.inc(action=action)
+            self.slow.append((time.time(), "handler", action, username, seconds))
+
+    def dump(self, seconds=PROFILE_SECONDS):
+        """Writes slow handlers, every task's stack and a sampled profile to DUMP_DIR.
+
+        Runs on the event loop; the sampling and the write happen on a thread.
+        Returns the path the dump will be written to, or None if one is running.
+        """
+        if self._profiling:
+            print("A dump is already being taken")
+            return None
+        self._profiling = True
+        os.makedirs(DUMP_DIR, exist_ok=True)
+        path = os.path.join(DUMP_DIR, f"dump-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+        # Tasks can only be listed safely from the loop's own thread
+        report = self._snapshot()
+        print(f"Profiling for {seconds:.0f}s into {path}")
+        threading.Thread(target=self._profile, args=(path, report, seconds), name="profiler", daemon=True).start()
+        return path
+
+    def respond(self, request_headers):
+        # GET /debug/profile with "Authorization: Bearer <ADMIN_TOKEN>"
+        if not ADMIN_TOKEN:
+            return HTTPStatus.NOT_FOUND, [], b"Not found\n"
+        supplied = request_headers.get("Authorization", "").encode("utf-8", "replace")
+        if not secrets.compare_digest(supplied, f"Bearer {ADMIN_TOKEN}".encode("utf-8")):
+            return HTTPStatus.UNAUTHORIZED, [], b"Unauthorized\n"
+        path = self.dump()
+        if path is None:
+            return HTTPStatus.CONFLICT, [], b"A dump is already being taken\n"
+        return HTTPStatus.ACCEPTED, [], f"Writing {path} in {PROFILE_SECONDS:.0f}s\n".encode("utf-8")
+
+    def _snapshot(self):
+        out = io.StringIO()
+        out.write(f"Dump of pid {os.getpid()} at {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+        out.write(f"== Slowest recent handlers and stalls (over {self.slow_handler * 1000:.0f} ms / "
+                  f"{self.slow_callback * 1000:.0f} ms) ==\n")
+        for when, kind, what, username, seconds in sorted(self.slow, key=lambda entry: entry[4], reverse=True):
+            who = f" by {username}" if username else ""
+            out.write(f"{seconds * 1000:9.1f} ms  {time.strftime('%H:%M:%S', time.localtime(when))}  {kind} {what}{who}\n")
+        tasks = sorted(asyncio.all_tasks(self._loop), key=lambda task: task.get_name())
+        out.write(f"\n== {len(tasks)} asyncio tasks ==\n")
+        for task in tasks:
+            out.write(f"\n{task.get_name()}:\n")
+            task.print_stack(limit=STACK_DEPTH, file=out)
+        return out.getvalue()
+
+    def _profile(self, path, report, seconds):
+        # Statistical profile of the loop thread: cheap, and blind to whatever is idle
+        samples = Counter()
+        interval = 1 / PROFILE_HZ
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline and not self._stopped.is_set():
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    samples[tuple(reversed(stack_of(frame)))] += 1
+                time.sleep(interval)
+            total = sum(samples.values()) or 1
+            leaves = Counter()
+            for stack, count in samples.items():
+                leaves[stack[-1]] += count
+            with open(path, "w") as f:
+                f.write(report)
+                f.write(f"\n== Profile: {total} samples over {seconds:.0f}s at {PROFILE_HZ:.0f} Hz, top frames ==\n")
+                for label, count in leaves.most_common(25):
+                    f.write(f"{100 * count / total:6.1f}%  {label}\n")
+                # Collapsed stacks, the input format of flamegraph.pl and speedscope
+                f.write("\n== Collapsed stacks ==\n")
+                for stack, count in samples.most_common():
+                    f.write(";".join(stack) + f" {count}\n")
+            DUMPS.inc()
+            print(f"Dump written to {path}")
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self._profiling = False
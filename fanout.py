@@ -0,0 +1,156 @@
+import asyncio
+import os
+from collections import deque
+
+import websockets
+
+import protocol
+
+# Max frames buffered per connection before the slow-consumer policy kicks in
+OUTBOX_SIZE = int(os.environ.get("OUTBOX_SIZE", "256"))
+# What to do when a recipient's outbox is full:
+#   drop       - discard the new frame
+#   coalesce   - evict the oldest queued frame so the newest traffic gets through
+#   disconnect - close the slow connection
+SLOW_CONSUMER_POLICY = os.environ.get("SLOW_CONSUMER_POLICY", "drop")
+
+POLICIES = ("drop", "coalesce", "disconnect")
+
+
+class Outbox:
+    """Bounded outbound queue for one connection, drained by its own writer task.
+
+    With a window, frames are numbered and kept until the client acks them, and
+    at most `window` are unacked at a time. Such an outbox outlives its
+    connection: it keeps queueing while detached and attach() resends whatever
+    the client did not ack.
+    """
+
+    def __init__(self, websocket, codec=protocol.JSON, maxsize=OUTBOX_SIZE, policy=SLOW_CONSUMER_POLICY, window=0):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.websocket = websocket
+        self.codec = codec
+        self.maxsize = maxsize
+        self.policy = policy
+        self.window = window
+        self.dropped = 0
+        self.closed = False
+        self.seq = 0  # Last sequence number sent
+        self._queue = deque()
+        self._unacked = deque()  # (seq, frame) sent but not yet acked
+        self._resend = deque()  # The part of _unacked still to be resent after attach()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._writer())
+
+    @property
+    def resumable(self):
+        return self.window > 0
+
+    def put(self, frame):
+        # frame is a protocol.Frame, encoded when written. Never awaits: the caller's latency does not depend on this socket
+        if self.closed:
+            return False
+        if len(self._queue) >= self.maxsize:
+            self.dropped += 1
+            if self.policy == "drop":
+                return False
+            if self.policy == "disconnect":
+                self.close()
+                asyncio.create_task(self.websocket.close(code=1013, reason="Slow consumer"))
+                return False
+            self._queue.popleft()
+        self._queue.append(frame)
+        self._wakeup.set()
+        return True
+
+    def pending(self):
+        return len(self._queue) + len(self._resend)
+
+    def unacked(self):
+        return len(self._unacked)
+
+    def ack(self, seq):
+        # Cumulative: everything up to seq arrived
+        while self._unacked and self._unacked[0][0] <= seq:
+            self._unacked.popleft()
+        self._wakeup.set()
+
+    def attach(self, websocket, codec, last_seq):
+        """Continues on a new connection; returns the number of frames resent."""
+        self._task.cancel()
+        self.websocket = websocket
+        self.codec = codec
+        self.ack(last_seq)
+        self._resend = deque(self._unacked)
+        self._task = asyncio.create_task(self._writer())
+        return len(self._resend)
+
+    def undelivered(self, unsent_only=False):
+        # Frames a resumable outbox could not confirm, oldest first. The client may have
+        # seen the unacked ones, but never the ones still queued.
+        if not self.resumable:
+            return []
+        frames = []
+        held = list(self._queue) if unsent_only else [frame for _, frame in self._unacked] + list(self._queue)
+        for frame in held:
+            if not frame.sequenced:
+                continue  # Recovered by whatever sent it, never queued offline
+            # An offline backlog is unpacked so it is not batched twice
+            if isinstance(frame, protocol.BatchFrame):
+                frames.extend(frame.frames)
+            elif frame.message.get("type") == "batch":  # Relayed over the bus as JSON
+                frames.extend(protocol.Frame(message) for message in frame.message["frames"])
+            else:
+                frames.append(frame)
+        return frames
+
+    async def _writer(self):
+        detached = False
+        try:
+            while True:
+                while self._resend:
+                    seq, frame = self._resend[0]
+                    await self.websocket.send(self.codec.sequenced(frame.encode(self.codec), seq))
+                    self._resend.popleft()
+                while self._queue and len(self._unacked) < self.window:
+                    frame = self._queue.popleft()
+                    if not frame.sequenced:
+                        await self.websocket.send(frame.encode(self.codec))
+                        continue
+                    self.seq += 1
+                    try:
+                        await self.websocket.send(self.codec.sequenced(frame.encode(self.codec), self.seq))
+                    except BaseException:
+                        # Never went out: it stays queued, and keeps its number for a resume
+                        self.seq -= 1
+                        self._queue.appendleft(frame)
+                        raise
+                    self._unacked.append((self.seq, frame))
+                while self._queue and not self.window:
+                    await self.websocket.send(self._queue.popleft().encode(self.codec))
+                self._wakeup.clear()
+                await self._wakeup.wait()
+        except websockets.exceptions.ConnectionClosed:
+            # Unacked frames stay for a resume; anything put meanwhile is queued
+            detached = self.resumable
+        finally:
+            # A writer replaced by attach() leaves the outbox to its successor
+            if not detached and self._task is asyncio.current_task():
+                self.closed = True
+                self._queue.clear()
+
+    def close(self):
+        self.closed = True
+        self._queue.clear()
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+
+
+def broadcast(outboxes, frame):
+    # Every recipient shares the same Frame, so it is encoded once per codec
+    delivered = 0
+    for outbox in outboxes:
+        if outbox.put(frame):
+            delivered += 1
+    return delivered
@@ -0,0 +1,263 @@
+import argparse
+import asyncio
+import json
+import random
+import resource
+import sys
+import time
+import urllib.request
+
+import websockets
+
+import protocol
+
+# Settings a scenario file may contain; command-line flags override them
+DEFAULTS = {
+    "name": "default",
+    "users": 100,
+    "groups": 10,
+    "groups_per_user": 1,
+    "rate": 500,  # Messages per second across all senders
+    "duration": 10,
+    "private_ratio": 0.5,
+    "message_size": 200,
+    "protocol": "json",
+    "connect_concurrency": 100,
+    "drain": 2,
+}
+
+TICK = 0.01
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.expected = 0
+        self.received = 0
+        self.latencies = []  # Seconds from scheduled send to delivery
+        self.errors = {}  # {server error message: count}
+
+
+class User:
+    def __init__(self, index, stats):
+        self.name = f"lg{index}"
+        self.groups = []
+        self.stats = stats
+        self.websocket = None
+        self.codec = protocol.JSON
+
+    async def connect(self, url, protocols):
+        self.websocket = await websockets.connect(url, compression=None, max_queue=None)
+        await self.websocket.send(json.dumps({
+            "action": "login",
+            "username": self.name,
+            "public_key": f"loadgen-{self.name}",
+            "protocols": protocols,
+        }))
+        _, welcome = protocol.decode(await self.websocket.recv())
+        if welcome.get("status") != "success":
+            raise RuntimeError(f"{self.name}: {welcome.get('message')}")
+        self.codec = protocol.CODECS[welcome.get("protocol", "json")]
+        for group in self.groups:
+            await self.send({"action": "join_group", "group": group})
+            await self.websocket.recv()
+
+    async def send(self, message):
+        await self.websocket.send(self.codec.encode(message))
+
+    async def receive(self):
+        try:
+            async for raw in self.websocket:
+                _, data = protocol.decode(raw)
+                frames = data["frames"] if data.get("type") == "batch" else [data]
+                for frame in frames:
+                    self.record(frame)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def record(self, frame):
+        if frame.get("type") in ("private", "group"):
+            # content is "<perf_counter at scheduled send>:<padding>"
+            sent_at = float(frame["content"].split(":", 1)[0])
+            self.stats.latencies.append(time.perf_counter() - sent_at)
+            self.stats.received += 1
+        elif frame.get("status") == "error":
+            message = frame.get("message", "")
+            self.stats.errors[message] = self.stats.errors.get(message, 0) + 1
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def server_memory(url):
+    # process_resident_memory_bytes from /metrics, summed over the workers that answered
+    metrics_url = url.replace("ws://", "http://", 1).replace("wss://", "https://", 1).rstrip("/") + "/metrics"
+    try:
+        with urllib.request.urlopen(metrics_url, timeout=5) as response:
+            text = response.read().decode("utf-8")
+    except OSError:
+        return None
+    values = [
+        float(line.rsplit(" ", 1)[1]) for line in text.splitlines()
+        if line.startswith("process_resident_memory_bytes")
+    ]
+    return sum(values) if values else None
+
+
+async def run(settings, url):
+    stats = Stats()
+    rng = random.Random(0)  # Same layout on every run so results stay comparable
+    users = [User(i, stats) for i in range(settings["users"])]
+    members = {f"lg-group{g}": [] for g in range(settings["groups"])}
+    group_names = list(members)
+    for user in users:
+        if group_names:
+            user.groups = rng.sample(group_names, min(settings["groups_per_user"], len(group_names)))
+            for group in user.groups:
+                members[group].append(user)
+
+    protocols = [settings["protocol"], "json"]
+    semaphore = asyncio.Semaphore(settings["connect_concurrency"])
+
+    async def connect(user):
+        async with semaphore:
+            await user.connect(url, protocols)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connect(user) for user in users))
+    print(f"Connected {len(users)} users in {time.perf_counter() - started:.1f}s")
+    memory_before = await asyncio.to_thread(server_memory, url)
+    receivers = [asyncio.create_task(user.receive()) for user in users]
+
+    padding = "x" * max(settings["message_size"] - 20, 0)
+    groups_with_peers = [group for group in group_names if len(members[group]) > 1]
+    # Open loop: sends follow the schedule even when the server falls behind, and
+    # latency is measured from the scheduled time so queueing delay is not hidden
+    began = time.perf_counter()
+    deadline = began + settings["duration"]
+    budget = 0.0
+    next_tick = began
+    while next_tick < deadline:
+        budget += settings["rate"] * TICK
+        while budget >= 1:
+            budget -= 1
+            content = f"{next_tick:.6f}:{padding}"
+            if groups_with_peers and rng.random() >= settings["private_ratio"]:
+                group = rng.choice(groups_with_peers)
+                sender = rng.choice(members[group])
+                await sender.send({"action": "group", "group": group, "content": content})
+                stats.expected += len(members[group]) - 1
+            else:
+                sender, target = rng.sample(users, 2)
+                await sender.send({"action": "private", "target": target.name, "content": content})
+                stats.expected += 1
+            stats.sent += 1
+        next_tick += TICK
+        delay = next_tick - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    send_seconds = time.perf_counter() - began
+
+    # Let in-flight deliveries arrive before measuring
+    await asyncio.sleep(settings["drain"])
+    elapsed = time.perf_counter() - began
+    memory_after = await asyncio.to_thread(server_memory, url)
+    for user in users:
+        await user.websocket.close()
+    await asyncio.gather(*receivers)
+
+    ordered = sorted(stats.latencies)
+    return {
+        "scenario": settings["name"],
+        "settings": settings,
+        "sent": stats.sent,
+        "send_rate": round(stats.sent / send_seconds, 1),
+        "expected_deliveries": stats.expected,
+        "delivered": stats.received,
+        "delivery_rate": round(stats.received / elapsed, 1),
+        "lost": stats.expected - stats.received,
+        "latency_ms": {
+            "p50": round(percentile(ordered, 0.50) * 1000, 3),
+            "p99": round(percentile(ordered, 0.99) * 1000, 3),
+            "p999": round(percentile(ordered, 0.999) * 1000, 3),
+            "max": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        },
+        "server_rss_mb": {
+            "before": round(memory_before / 2**20, 1) if memory_before else None,
+            "after": round(memory_after / 2**20, 1) if memory_after else None,
+        },
+        "errors": stats.errors,
+    }
+
+
+def compare(result, baseline, tolerance):
+    # Regressions beyond the tolerance fail the run, so this can gate a release
+    failures = []
+    for key in ("p50", "p99", "p999"):
+        old, new = baseline["latency_ms"][key], result["latency_ms"][key]
+        if old and new > old * (1 + tolerance):
+            failures.append(f"{key} latency {old} ms -> {new} ms")
+    if result["delivery_rate"] < baseline["delivery_rate"] * (1 - tolerance):
+        failures.append(f"delivery rate {baseline['delivery_rate']}/s -> {result['delivery_rate']}/s")
+    old_rss, new_rss = baseline["server_rss_mb"]["after"], result["server_rss_mb"]["after"]
+    if old_rss and new_rss and new_rss > old_rss * (1 + tolerance):
+        failures.append(f"server RSS {old_rss} MB -> {new_rss} MB")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless load generator for the chat server.")
+    parser.add_argument("--url", default="ws://localhost:8765")
+    parser.add_argument("--scenario", help="JSON file with settings (see scenarios/)")
+    for key, value in DEFAULTS.items():
+        parser.add_argument("--" + key.replace("_", "-"), type=type(value), default=None)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Results file from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression vs the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    settings = dict(DEFAULTS)
+    if args.scenario:
+        with open(args.scenario) as f:
+            settings.update(json.load(f))
+    for key in DEFAULTS:
+        value = getattr(args, key)
+        if value is not None:
+            settings[key] = value
+    if settings["protocol"] not in protocol.CODECS:
+        parser.error(f"Protocol {settings['protocol']} is not available here")
+    if settings["users"] < 2:
+        parser.error("Need at least 2 users")
+
+    # Thousands of sockets need more than the usual 1024 descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    result = asyncio.run(run(settings, args.url))
+
+    latency = result["latency_ms"]
+    print(f"Scenario {result['scenario']}: sent {result['sent']} ({result['send_rate']}/s), "
+          f"delivered {result['delivered']}/{result['expected_deliveries']} ({result['delivery_rate']}/s), lost {result['lost']}")
+    print(f"Latency ms: p50 {latency['p50']}  p99 {latency['p99']}  p999 {latency['p999']}  max {latency['max']}")
+    rss = result["server_rss_mb"]
+    print(f"Server RSS MB: before {rss['before']}  after {rss['after']}")
+    for message, count in result["errors"].items():
+        print(f"Server error x{count}: {message}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(result, json.load(f), args.tolerance)
+        for failure in failures:
+            print(f"REGRESSION: {failure}")
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
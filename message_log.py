@@ -0,0 +1,316 @@
+import asyncio
+import base64
+import bisect
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+
+# Root directory for conversation logs
+MESSAGE_LOG_DIR = os.environ.get("MESSAGE_LOG_DIR", "data/messages")
+# A new segment file is started once the active one reaches this size
+LOG_SEGMENT_BYTES = int(os.environ.get("LOG_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+# One index entry roughly every this many bytes of log
+LOG_INDEX_INTERVAL = int(os.environ.get("LOG_INDEX_INTERVAL", "4096"))
+# Appends are buffered and written in one batch per conversation at this interval
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "0.05"))
+LOG_FSYNC = os.environ.get("LOG_FSYNC", "0") == "1"
+# Upper bound on messages returned by one history request
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "100"))
+
+# Record: header (payload length, timestamp), payload, trailer (payload length).
+# The trailer lets pages be read backwards from any record boundary.
+_HEADER = struct.Struct("!Id")
+_TRAILER = struct.Struct("!I")
+_OVERHEAD = _HEADER.size + _TRAILER.size
+# Sparse index entry: byte position within the segment, timestamp of that record
+_INDEX_ENTRY = struct.Struct("!Qd")
+# Conversation directories are named by the base64 of their key while that fits a
+# path component (255 bytes on most filesystems), and by its hash beyond that
+_MAX_DIR_NAME = 200
+
+
+def group_key(group_name):
+    return "group:" + group_name
+
+
+def private_key(user_a, user_b):
+    # Both sides of a conversation map to the same log
+    return "dm:" + "\0".join(sorted((user_a, user_b)))
+
+
+class _Segments:
+    """Read-only mmap view of a conversation's segments at one point in time."""
+
+    def __init__(self, path):
+        self.path = path
+        self.bases = []
+        self.maps = []
+        if not os.path.isdir(path):
+            return
+        with open(os.path.join(path, "lock"), "a") as lock:
+            # Shared lock: sizes are taken between writer batches, never mid-record
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            for base in _list_bases(path):
+                with open(_log_path(path, base), "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    if size:
+                        self.bases.append(base)
+                        self.maps.append(mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ))
+
+    def close(self):
+        for mm in self.maps:
+            mm.close()
+
+    def index(self, i):
+        index_path = _index_path(self.path, self.bases[i])
+        if not os.path.exists(index_path):
+            return []
+        with open(index_path, "rb") as f:
+            return list(_INDEX_ENTRY.iter_unpack(f.read()))
+
+    def record(self, i, pos):
+        mm = self.maps[i]
+        length, ts = _HEADER.unpack_from(mm, pos)
+        start = pos + _HEADER.size
+        return ts, mm[start:start + length], start + length + _TRAILER.size
+
+    def align(self, offset):
+        # First record boundary at or after offset, found from the nearest index entry
+        i = max(bisect.bisect_right(self.bases, offset) - 1, 0)
+        target = offset - self.bases[i]
+        entries = self.index(i)
+        j = bisect.bisect_right([entry[0] for entry in entries], target) - 1
+        pos = entries[j][0] if j >= 0 else 0
+        while pos < target and pos < len(self.maps[i]):
+            pos = self.record(i, pos)[2]
+        return self._normalize(i, pos)
+
+    def seek_time(self, since):
+        # First record with timestamp >= since
+        firsts = []
+        for i in range(len(self.bases)):
+            entries = self.index(i)
+            firsts.append(entries[0][1] if entries else 0)
+        i = max(bisect.bisect_left(firsts, since) - 1, 0)
+        entries = self.index(i)
+        j = bisect.bisect_left([entry[1] for entry in entries], since) - 1
+        pos = entries[j][0] if j >= 0 else 0
+        i, pos = self._normalize(i, pos)
+        while pos < len(self.maps[i]):
+            ts, _, end = self.record(i, pos)
+            if ts >= since:
+                break
+            i, pos = self._normalize(i, end)
+        return i, pos
+
+    def _normalize(self, i, pos):
+        # Step over segment ends so (i, pos) always points at a record or the log end
+        while i < len(self.maps) - 1 and pos >= len(self.maps[i]):
+            i, pos = i + 1, 0
+        return i, pos
+
+    def end(self):
+        return len(self.maps) - 1, len(self.maps[-1])
+
+    def forward(self, i, pos, limit):
+        records = []
+        i, pos = self._normalize(i, pos)
+        while pos < len(self.maps[i]) and len(records) < limit:
+            ts, payload, end = self.record(i, pos)
+            records.append((self.bases[i] + pos, ts, payload))
+            i, pos = self._normalize(i, end)
+        return records, self.bases[i] + pos
+
+    def backward(self, i, pos, limit):
+        records = []
+        while len(records) < limit:
+            if pos == 0:
+                if i == 0:
+                    break
+                i -= 1
+                pos = len(self.maps[i])
+                continue
+            (length,) = _TRAILER.unpack_from(self.maps[i], pos - _TRAILER.size)
+            pos -= length + _OVERHEAD
+            ts, payload, _ = self.record(i, pos)
+            records.append((self.bases[i] + pos, ts, payload))
+        records.reverse()
+        return records
+
+
+def _list_bases(path):
+    return sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith(".log"))
+
+
+def _log_path(path, base):
+    return os.path.join(path, f"{base:020d}.log")
+
+
+def _index_path(path, base):
+    return os.path.join(path, f"{base:020d}.idx")
+
+
+class MessageLog:
+    """Append-only, segmented store of already-encrypted message frames, one log per conversation."""
+
+    def __init__(self, directory=MESSAGE_LOG_DIR, flush_interval=LOG_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._buffers = {}  # {conversation key: [(timestamp, payload bytes)]}
+        self._flush_lock = asyncio.Lock()
+        self._closing = False
+        self._task = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._task = asyncio.create_task(self._run())
+
+    def _path(self, key):
+        name = base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii").rstrip("=")
+        if len(name) > _MAX_DIR_NAME:
+            # Too long for one path component; "~" is outside the base64 alphabet, so no clash
+            name = "~" + hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def append(self, key, frame):
+        # frame is the serialized JSON sent to recipients; it is stored as-is
+        self._buffers.setdefault(key, []).append((time.time(), frame.encode("utf-8")))
+
+    async def _run(self):
+        while not self._closing:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buffers:
+                return
+            buffers, self._buffers = self._buffers, {}
+            await asyncio.to_thread(self._write_all, buffers)
+
+    def _write_all(self, buffers):
+        for key, records in buffers.items():
+            try:
+                self._write_batch(self._path(key), records)
+            except OSError as e:
+                print(f"Error writing message log for {key}: {e}")
+
+    def _write_batch(self, path, records):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "lock"), "a") as lock:
+            # Exclusive lock: other worker processes may append to the same conversation
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            bases = _list_bases(path) or [0]
+            base = bases[-1]
+            size = os.path.getsize(_log_path(path, base)) if os.path.exists(_log_path(path, base)) else 0
+            if size >= LOG_SEGMENT_BYTES:
+                base, size = base + size, 0
+
+            index_path = _index_path(path, base)
+            last_indexed = None
+            if os.path.exists(index_path) and os.path.getsize(index_path):
+                with open(index_path, "rb") as f:
+                    f.seek(-_INDEX_ENTRY.size, os.SEEK_END)
+                    last_indexed = _INDEX_ENTRY.unpack(f.read())[0]
+
+            chunks = []
+            entries = []
+            pos = size
+            for ts, payload in records:
+                if last_indexed is None or pos - last_indexed >= LOG_INDEX_INTERVAL:
+                    entries.append(_INDEX_ENTRY.pack(pos, ts))
+                    last_indexed = pos
+                chunks.append(_HEADER.pack(len(payload), ts))
+                chunks.append(payload)
+                chunks.append(_TRAILER.pack(len(payload)))
+                pos += len(payload) + _OVERHEAD
+
+            with open(_log_path(path, base), "ab") as log:
+                log.write(b"".join(chunks))
+                log.flush()
+                if LOG_FSYNC:
+                    os.fsync(log.fileno())
+            if entries:
+                with open(index_path, "ab") as index:
+                    index.write(b"".join(entries))
+
+    def read(self, key, offset=None, since=None, before=None, limit=HISTORY_PAGE_SIZE):
+        """Return (records, next_offset) where records are (offset, timestamp, frame bytes).
+
+        offset/since page forwards from a record offset or a timestamp; otherwise the
+        page ends just before `before` (or at the newest message).
+        """
+        segments = _Segments(self._path(key))
+        try:
+            if not segments.maps:
+                return [], None
+            if offset is not None:
+                return segments.forward(*segments.align(offset), limit)
+            if since is not None:
+                return segments.forward(*segments.seek_time(since), limit)
+            i, pos = segments.align(before) if before is not None else segments.end()
+            return segments.backward(i, pos, limit), segments.bases[i] + pos
+        finally:
+            segments.close()
+
+    def read_between(self, keys, since, until, limit):
+        """Frame bytes logged in [since, until) across several conversations, oldest first.
+
+        At most the newest `limit` records before `until` are taken from each conversation.
+        A conversation whose newest segment was last written before `since` costs a stat.
+        """
+        found = []
+        for key in keys:
+            path = self._path(key)
+            bases = _list_bases(path) if os.path.isdir(path) else []
+            if not bases or os.path.getmtime(_log_path(path, bases[-1])) < since:
+                continue
+            segments = _Segments(path)
+            try:
+                if not segments.maps:
+                    continue
+                records = segments.backward(*segments.seek_time(until), limit)
+            finally:
+                segments.close()
+            found.extend((ts, payload) for _, ts, payload in records if ts >= since)
+        found.sort(key=lambda record: record[0])
+        return [payload for _, payload in found]
+
+    async def missed(self, keys, since, until, limit):
+        # Make our own buffered appends visible, then read off the event loop
+        await self.flush()
+        return await asyncio.to_thread(self.read_between, keys, since, until, limit)
+
+    async def history(self, key, offset=None, since=None, before=None, limit=HISTORY_PAGE_SIZE):
+        # Make our own buffered appends visible, then read off the event loop
+        await self.flush()
+        return await asyncio.to_thread(self.read, key, offset, since, before, limit)
+
+    async def close(self):
+        self._closing = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+
+def history_frame(conversation, records, next_offset):
+    # Stored payloads are already JSON, so they are spliced in without re-encoding
+    messages = b",".join(
+        b'{"offset":%d,"ts":%.3f,"message":%s}' % (offset, ts, payload)
+        for offset, ts, payload in records
+    ).decode("utf-8")
+    head = json.dumps({
+        "type": "history",
+        **conversation,
+        "prev_offset": records[0][0] if records else None,
+        "next_offset": next_offset,
+    })
+    return head[:-1] + ', "messages": [' + messages + "]}"
@@ -0,0 +1,82 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+import protocol
+
+# Undelivered frames kept per recipient; the oldest are dropped beyond this
+OFFLINE_QUEUE_SIZE = int(os.environ.get("OFFLINE_QUEUE_SIZE", "500"))
+# Seconds an undelivered frame is kept (default one week)
+OFFLINE_TTL = int(os.environ.get("OFFLINE_TTL", str(7 * 24 * 3600)))
+# Frames per batch frame when a backlog is delivered on login
+OFFLINE_BATCH_SIZE = int(os.environ.get("OFFLINE_BATCH_SIZE", "100"))
+SWEEP_INTERVAL = 60
+# Frame types still worth delivering at the next login; presence, membership and
+# file transfer frames are stale by then
+KEPT_TYPES = frozenset(("private", "group", "sender_key"))
+
+
+class OfflineQueues:
+    """Bounded, expiring store of frames for users who are not connected.
+
+    Only direct frames are queued. Group messages are never queued per member;
+    they are read back from the message log at login.
+    """
+
+    def __init__(self, maxlen=OFFLINE_QUEUE_SIZE, ttl=OFFLINE_TTL):
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self._queues = {}  # {username: deque of (expires_at, frame)}
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, username, frame):
+        queue = self._queues.get(username)
+        if queue is None:
+            queue = self._queues[username] = deque(maxlen=self.maxlen)
+        queue.append((int(time.time()) + self.ttl, frame))
+
+    def take(self, username):
+        queue = self._queues.pop(username, None)
+        if not queue:
+            return []
+        now = time.time()
+        return [frame for expires_at, frame in queue if expires_at > now]
+
+    def pending(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def __contains__(self, username):
+        return username in self._queues
+
+    def sweep(self):
+        # Frames are queued in time order, so expired ones are always at the front
+        now = time.time()
+        for username in list(self._queues):
+            queue = self._queues[username]
+            while queue and queue[0][0] <= now:
+                queue.popleft()
+            if not queue:
+                del self._queues[username]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self.sweep()
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+
+
+def keeps(frame):
+    return frame.message.get("type") in KEPT_TYPES
+
+
+def batch_frames(frames, size=OFFLINE_BATCH_SIZE):
+    # Frames are already JSON, so batches are spliced together without re-encoding
+    for start in range(0, len(frames), size):
+        yield protocol.BatchFrame(frames[start:start + size])
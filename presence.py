@@ -0,0 +1,185 @@
+import asyncio
+import os
+import time
+
+import metrics
+import protocol
+
+# Presence and typing changes are collected for this many seconds, then each
+# subscriber gets at most one "presence" frame describing all of them
+PRESENCE_TICK = float(os.environ.get("PRESENCE_TICK", "0.25"))
+# A user who reconnects within this many seconds is never announced offline,
+# so flapping connections cost their groups nothing
+PRESENCE_GRACE = float(os.environ.get("PRESENCE_GRACE", "5"))
+# Repeated typing notices from one user in one group are dropped for this long;
+# clients show the indicator until they hear nothing for a few seconds
+TYPING_INTERVAL = float(os.environ.get("TYPING_INTERVAL", "3"))
+
+PRESENCE_FRAMES = metrics.Counter("chat_presence_frames_total", "Presence delta frames queued for subscribers.")
+
+
+class Presence:
+    """Coalesces online/offline and typing changes into one delta frame per subscriber per tick.
+
+    Subscribers are the online members of the groups a user belongs to, so
+    presence costs nothing for users who share no group. `online_members` is
+    this worker's {group name: {username: outbox}} index and `connected` its
+    {username: outbox}; `publish(typing)` forwards typing started on this
+    worker to the others.
+    """
+
+    def __init__(self, online_members, connected, publish, tick=PRESENCE_TICK, grace=PRESENCE_GRACE,
+                 typing_interval=TYPING_INTERVAL):
+        self.online_members = online_members
+        self.connected = connected
+        self.publish = publish
+        self.tick = tick
+        self.grace = grace
+        self.typing_interval = typing_interval
+        self._groups = {}  # {username: set of group names} for users online anywhere or within their grace period
+        self._members = {}  # {group name: set of those usernames}
+        self._announced = set()  # Users subscribers have been told are online
+        self._leaving = {}  # {username: monotonic deadline} disconnected but not yet announced offline
+        self._changed = set()  # Users who may need announcing as online
+        self._snapshots = set()  # Local users who need the full online list of their groups
+        self._typing = {}  # {group name: set of usernames} typing this tick
+        self._local_typing = {}  # The part of _typing that started on this worker
+        self._typing_seen = {}  # {(username, group name): monotonic time of the last notice kept}
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+
+    def online(self, username, group_names, local=False):
+        # A reconnect within the grace period cancels the pending offline; nothing is announced
+        self._leaving.pop(username, None)
+        self._groups.setdefault(username, set())
+        for group_name in group_names:
+            self._add_member(username, group_name)
+        if username not in self._announced:
+            self._changed.add(username)
+        if local:
+            self._snapshots.add(username)
+
+    def offline(self, username):
+        if username in self._groups:
+            self._leaving[username] = time.monotonic() + self.grace
+
+    def joined(self, username, group_name, local=False):
+        if username not in self._groups or group_name in self._groups[username]:
+            return
+        self._add_member(username, group_name)
+        # Re-announced so the new group's members hear about them
+        self._announced.discard(username)
+        self._changed.add(username)
+        if local:
+            self._snapshots.add(username)
+
+    def typing(self, username, group_name, local=False):
+        if local:
+            now = time.monotonic()
+            seen = self._typing_seen.get((username, group_name))
+            if seen is not None and now - seen < self.typing_interval:
+                return
+            self._typing_seen[(username, group_name)] = now
+            self._local_typing.setdefault(group_name, set()).add(username)
+        self._typing.setdefault(group_name, set()).add(username)
+
+    def _add_member(self, username, group_name):
+        self._groups[username].add(group_name)
+        self._members.setdefault(group_name, set()).add(username)
+
+    def _remove(self, username):
+        for group_name in self._groups.pop(username, ()):
+            members = self._members.get(group_name)
+            if members is not None:
+                members.discard(username)
+                if not members:
+                    del self._members[group_name]
+        self._announced.discard(username)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                typing = self.flush()
+                if typing:
+                    await self.publish(typing)
+            except Exception as e:
+                print(f"Error flushing presence: {e}")
+
+    def flush(self):
+        """Sends this tick's deltas; returns the local typing to forward to other workers."""
+        now = time.monotonic()
+        deltas = {}  # {subscriber: (online set, offline set, {group name: set of usernames})}
+
+        def delta(subscriber):
+            entry = deltas.get(subscriber)
+            if entry is None:
+                entry = deltas[subscriber] = (set(), set(), {})
+            return entry
+
+        def notify(username, index):
+            for group_name in self._groups.get(username, ()):
+                for subscriber in self.online_members.get(group_name, ()):
+                    if subscriber != username:
+                        delta(subscriber)[index].add(username)
+
+        for username in self._changed:
+            if username in self._groups and username not in self._leaving and username not in self._announced:
+                self._announced.add(username)
+                notify(username, 0)
+        self._changed.clear()
+
+        for username in [u for u, deadline in self._leaving.items() if deadline <= now]:
+            del self._leaving[username]
+            if username in self._announced:
+                notify(username, 1)
+            self._remove(username)
+
+        for username in self._snapshots:
+            online = delta(username)[0]
+            for group_name in self._groups.get(username, ()):
+                online.update(self._members.get(group_name, ()))
+            online.difference_update(self._leaving)
+            online.intersection_update(self._announced)
+            online.discard(username)
+        self._snapshots.clear()
+
+        for group_name, typists in self._typing.items():
+            for subscriber in self.online_members.get(group_name, ()):
+                others = typists - {subscriber}
+                if others:
+                    delta(subscriber)[2].setdefault(group_name, set()).update(others)
+        self._typing = {}
+        if self._typing_seen:
+            self._typing_seen = {key: seen for key, seen in self._typing_seen.items() if now - seen < self.typing_interval}
+
+        # Members of one group usually get identical deltas, so they share one Frame
+        frames = {}
+        for subscriber, (online, offline, typing) in deltas.items():
+            if not (online or offline or typing):
+                continue
+            key = (frozenset(online), frozenset(offline), frozenset((g, frozenset(u)) for g, u in typing.items()))
+            frame = frames.get(key)
+            if frame is None:
+                message = {"type": "presence"}
+                if online:
+                    message["online"] = sorted(online)
+                if offline:
+                    message["offline"] = sorted(offline)
+                if typing:
+                    message["typing"] = {group_name: sorted(users) for group_name, users in typing.items()}
+                frame = frames[key] = protocol.Frame(message)
+            outbox = self.connected.get(subscriber)
+            if outbox is not None:
+                outbox.put(frame)
+                PRESENCE_FRAMES.inc()
+
+        local_typing = {group_name: sorted(users) for group_name, users in self._local_typing.items()}
+        self._local_typing = {}
+        return local_typing
@@ -0,0 +1,311 @@
+import base64
+import binascii
+import json
+import re
+import struct
+
+try:
+    import msgpack
+except ImportError:  # binary framing is optional; JSON always works
+    msgpack = None
+
+# Client -> server action codes
+LOGIN = 1
+GET_KEY = 2
+GET_KEYS = 3
+PRIVATE = 4
+JOIN_GROUP = 5
+GROUP = 6
+HISTORY = 7
+TYPING = 8
+ACK = 9
+RESUME = 10
+SENDER_KEY = 11
+MEMBERS = 12
+FILE_OFFER = 13
+FILE_CHUNK = 14
+FILE_CREDIT = 15
+FILE_CANCEL = 16
+
+ACTION_CODES = {
+    "login": LOGIN,
+    "get_key": GET_KEY,
+    "get_keys": GET_KEYS,
+    "private": PRIVATE,
+    "join_group": JOIN_GROUP,
+    "group": GROUP,
+    "history": HISTORY,
+    "typing": TYPING,
+    "ack": ACK,
+    "resume": RESUME,
+    "sender_key": SENDER_KEY,
+    "members": MEMBERS,
+    "file_offer": FILE_OFFER,
+    "file_chunk": FILE_CHUNK,
+    "file_credit": FILE_CREDIT,
+    "file_cancel": FILE_CANCEL,
+}
+
+# Server -> client frame codes
+STATUS = 64
+TYPE_CODES = {
+    "pub_key": 65,
+    "pub_keys": 66,
+    "private": 67,
+    "group": 68,
+    "history": 69,
+    "batch": 70,
+    "presence": 71,
+    "sender_key": 72,
+    "members": 73,
+    "member": 74,
+    "file_offer": 75,
+    "file_chunk": 76,
+    "file_credit": 77,
+    "file_cancel": 78,
+}
+BATCH = TYPE_CODES["batch"]
+UNKNOWN = 0
+
+ACTION_NAMES = {code: name for name, code in ACTION_CODES.items()}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+# Binary frame header: version, code, flags, sequence number
+HEADER = struct.Struct("!BBHI")
+BINARY_VERSION = 1
+# The sequence number is the last header field, so it can be patched into an encoded frame
+SEQ = struct.Struct("!I")
+SEQ_OFFSET = HEADER.size - SEQ.size
+
+# Hot-path frames are positional arrays, so field names never go over the wire.
+# Every other code carries a msgpack map.
+LAYOUTS = {
+    PRIVATE: ("target", "content", "encrypted_key", "key_id", "control"),
+    GROUP: ("group", "content", "key_id"),
+    TYPE_CODES["private"]: ("from", "content", "encrypted_key", "key_id", "control"),
+    TYPE_CODES["group"]: ("group", "from", "content", "key_id"),
+    FILE_CHUNK: ("transfer_id", "index", "content"),
+    TYPE_CODES["file_chunk"]: ("transfer_id", "index", "content"),
+}
+
+# Base64 text fields sent as raw bytes in binary frames (Fernet tokens are urlsafe)
+RAW_FIELDS = {
+    "content": (base64.urlsafe_b64decode, base64.urlsafe_b64encode),
+    "encrypted_key": (base64.b64decode, base64.b64encode),
+}
+
+
+# File transfer ids: 128 bits in lowercase hex. Receivers name .part files after
+# them, so nothing else is ever accepted.
+TRANSFER_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def valid_transfer_id(transfer_id):
+    return isinstance(transfer_id, str) and TRANSFER_ID.fullmatch(transfer_id) is not None
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def message_code(message):
+    if "action" in message:
+        return ACTION_CODES.get(message["action"], UNKNOWN)
+    if "type" in message:
+        return TYPE_CODES.get(message["type"], UNKNOWN)
+    if "status" in message:
+        return STATUS
+    return UNKNOWN
+
+
+class JsonCodec:
+    name = "json"
+
+    def encode(self, message):
+        return json.dumps(message)
+
+    def sequenced(self, encoded, seq):
+        # Spliced in front of the other fields, so a shared frame is not re-encoded per recipient
+        return '{"seq": %d, ' % seq + encoded[1:]
+
+    def decode(self, raw):
+        try:
+            message = json.loads(raw)
+        except RecursionError:
+            raise ProtocolError("Frame nested too deeply")
+        if not isinstance(message, dict):
+            raise ProtocolError("Frame must be a JSON object")
+        return message_code(message), message
+
+
+class BinaryCodec:
+    name = "binary-v1"
+
+    def encode(self, message, seq=0):
+        code = message_code(message)
+        layout = LAYOUTS.get(code)
+        if layout:
+            body = [_to_wire(field, message.get(field)) for field in layout]
+        elif code == BATCH:
+            # Batches relayed as JSON are re-encoded the way BatchFrame builds them
+            body = [self.encode(frame) for frame in message["frames"]]
+        else:
+            body = message
+        return HEADER.pack(BINARY_VERSION, code, 0, seq) + msgpack.packb(body, use_bin_type=True)
+
+    def sequenced(self, encoded, seq):
+        return encoded[:SEQ_OFFSET] + SEQ.pack(seq) + encoded[HEADER.size:]
+
+    def decode(self, raw, nested=False):
+        if len(raw) < HEADER.size:
+            raise ProtocolError("Short frame")
+        version, code, _flags, seq = HEADER.unpack_from(raw)
+        if version != BINARY_VERSION:
+            raise ProtocolError(f"Unsupported frame version {version}")
+        try:
+            body = msgpack.unpackb(memoryview(raw)[HEADER.size:], raw=False)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise ProtocolError(f"Bad frame body: {e}")
+
+        layout = LAYOUTS.get(code)
+        if layout:
+            if not isinstance(body, list) or len(body) != len(layout):
+                raise ProtocolError("Frame does not match its layout")
+            message = {field: _from_wire(field, value) for field, value in zip(layout, body) if value is not None}
+        elif code == BATCH:
+            # One level only: a batch holds ordinary frames, never other batches
+            if nested:
+                raise ProtocolError("Batches do not nest")
+            if not isinstance(body, list) or not all(isinstance(frame, bytes) for frame in body):
+                raise ProtocolError("Batch must be a list of frames")
+            message = {"type": "batch", "frames": [self.decode(frame, nested=True)[1] for frame in body]}
+            if seq:
+                message["seq"] = seq
+            return code, message
+        elif isinstance(body, dict):
+            message = body
+        else:
+            raise ProtocolError("Frame body must be a map")
+
+        if code in ACTION_NAMES:
+            message["action"] = ACTION_NAMES[code]
+        elif code in TYPE_NAMES:
+            message["type"] = TYPE_NAMES[code]
+        if seq:
+            message["seq"] = seq
+        return code, message
+
+
+def _to_wire(field, value):
+    # Send base64 text as raw bytes, but only when it round-trips exactly
+    # (web clients send plain text content)
+    if field in RAW_FIELDS and isinstance(value, str):
+        unpack, pack = RAW_FIELDS[field]
+        try:
+            raw = unpack(value)
+        except (binascii.Error, ValueError):
+            return value
+        if pack(raw).decode("ascii") == value:
+            return raw
+    return value
+
+
+def _from_wire(field, value):
+    if field in RAW_FIELDS and isinstance(value, bytes):
+        return RAW_FIELDS[field][1](value).decode("ascii")
+    return value
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec() if msgpack else None
+CODECS = {codec.name: codec for codec in (BINARY, JSON) if codec}
+
+
+def available():
+    # In order of preference, for the login "protocols" list
+    return list(CODECS)
+
+
+def negotiate(offered):
+    for name in offered or ():
+        if name in CODECS:
+            return CODECS[name]
+    return JSON
+
+
+def decode(raw):
+    # Text frames are JSON, binary frames use the binary codec
+    if isinstance(raw, str):
+        return JSON.decode(raw)
+    if BINARY is None:
+        raise ProtocolError("Binary frames are not supported")
+    return BINARY.decode(raw)
+
+
+class Frame:
+    """A server -> client message, encoded at most once per codec however many recipients get it."""
+
+    __slots__ = ("_message", "_encoded")
+
+    # Numbered and kept until acked when sent to a reliable session
+    sequenced = True
+
+    def __init__(self, message):
+        self._message = message
+        self._encoded = {}
+
+    @classmethod
+    def from_json(cls, text):
+        # Frames arriving from the bus or the message log are already JSON
+        frame = cls(None)
+        frame._encoded[JSON.name] = text
+        return frame
+
+    @property
+    def message(self):
+        if self._message is None:
+            self._message = json.loads(self._encoded[JSON.name])
+        return self._message
+
+    @property
+    def json(self):
+        return self.encode(JSON)
+
+    def encode(self, codec):
+        encoded = self._encoded.get(codec.name)
+        if encoded is None:
+            encoded = self._encoded[codec.name] = codec.encode(self.message)
+        return encoded
+
+
+class TransientFrame(Frame):
+    """A frame that is neither numbered nor kept for resume, such as a file chunk.
+
+    Whatever is lost is re-requested by the receiver, so holding it for acks
+    would only cost memory.
+    """
+
+    __slots__ = ()
+
+    sequenced = False
+
+
+class BatchFrame(Frame):
+    """Several frames delivered as one, built from the already-encoded members."""
+
+    __slots__ = ("frames",)
+
+    def __init__(self, frames):
+        super().__init__(None)
+        self.frames = frames
+
+    def encode(self, codec):
+        encoded = self._encoded.get(codec.name)
+        if encoded is None:
+            if codec is JSON:
+                encoded = '{"type": "batch", "frames": [' + ", ".join(frame.json for frame in self.frames) + "]}"
+            else:
+                encoded = HEADER.pack(BINARY_VERSION, BATCH, 0, 0) + msgpack.packb(
+                    [frame.encode(codec) for frame in self.frames], use_bin_type=True)
+            self._encoded[codec.name] = encoded
+        return encoded
@@ -1,137 +1,1024 @@
+import time
+STARTUP_BEGAN = time.perf_counter()
 import asyncio
+import functools
+import hashlib
+import multiprocessing
+import resource
+import secrets
+import signal
+import sys
+from collections import deque
+from http import HTTPStatus
 import websockets
-import json
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+import admission
+import assets
+import bus
+import cache
 import database
+import diagnostics
+import fanout
+import message_log
+import metrics
+import offline
+import presence
+import protocol
+import transfers
+import write_behind
 
-# Initialize Database
-database.init_db()
+# Initialize Database; without storage every login and join would be lost, so refuse to start
+if not database.init_db():
+    raise SystemExit(f"Storage unavailable ({database.engine.__name__}), check DATABASE_URL")
 import os
 
-# Store connected users: {username: websocket}
-# Store connected users: {username: websocket}
+HOST = "localhost"
+PORT = 8765
+# Number of worker processes sharing the port (SO_REUSEPORT); 1 = single process
+WORKERS = int(os.environ.get("WORKERS", "1"))
+
+# Cache bounds; entries are loaded from the database on first use
+KEY_CACHE_SIZE = int(os.environ.get("KEY_CACHE_SIZE", "10000"))
+KEY_CACHE_TTL = float(os.environ.get("KEY_CACHE_TTL", "3600"))
+GROUP_CACHE_SIZE = int(os.environ.get("GROUP_CACHE_SIZE", "10000"))
+GROUP_CACHE_TTL = float(os.environ.get("GROUP_CACHE_TTL", "300"))
+# Upper bound on targets in one get_keys request
+MAX_KEYS_PER_REQUEST = int(os.environ.get("MAX_KEYS_PER_REQUEST", "1000"))
+# Upper bound on wrapped keys in one sender_key request; bigger groups take several
+MAX_ENVELOPES_PER_REQUEST = int(os.environ.get("MAX_ENVELOPES_PER_REQUEST", "1000"))
+# permessage-deflate for clients that ask for it. Smaller windows and memLevel
+# cut per-connection zlib memory; encrypted payloads barely compress anyway.
+WS_COMPRESSION = os.environ.get("WS_COMPRESSION", "1") == "1"
+WS_DEFLATE_WINDOW_BITS = int(os.environ.get("WS_DEFLATE_WINDOW_BITS", "11"))
+WS_DEFLATE_MEM_LEVEL = int(os.environ.get("WS_DEFLATE_MEM_LEVEL", "4"))
+# Clients that log in with "reliable": true get numbered frames they ack, at most
+# ACK_WINDOW unacked at a time, and can resume a dropped connection for RESUME_GRACE seconds
+ACK_WINDOW = int(os.environ.get("ACK_WINDOW", "256"))
+RESUME_GRACE = float(os.environ.get("RESUME_GRACE", "30"))
+# How long a login waits for another worker to hand over a session held for resume
+TAKEOVER_TIMEOUT = 1.0
+# How long joins and logouts heard from another worker are applied to what is
+# loaded from storage; far longer than that worker takes to flush them (WRITE_FLUSH_INTERVAL)
+REMOTE_WRITE_TTL = 60.0
+# Group frames are also kept in memory this many seconds after they arrive, far
+# longer than any worker takes to flush its message log (LOG_FLUSH_INTERVAL).
+# A login replays the newest from memory and only older ones from the log.
+GROUP_REPLAY_OVERLAP = float(os.environ.get("GROUP_REPLAY_OVERLAP", "2"))
+
+# Store connected users: {username: fanout.Outbox}
 connected_users = {}
-# Store public keys: {username: pem_string}
-public_keys = database.get_all_users()
+# Store public keys: {username: pem_string or None}
+public_keys = cache.LRUCache(KEY_CACHE_SIZE, KEY_CACHE_TTL)
 
 # Store groups: {group_name: {set of usernames}}
-groups = database.get_all_groups()
+groups = cache.LRUCache(GROUP_CACHE_SIZE, GROUP_CACHE_TTL)
+
+# Members of each group who are online on this worker: {group_name: {username: fanout.Outbox}}.
+# Persistent membership stays in `groups`; this only tracks who can be delivered to right now.
+online_members = {}
+# Reverse index for this worker's online users: {username: set of group names}
+user_groups = {}
+
+# Resume tokens of reliable sessions: {username: token}
+resume_tokens = {}
+# Reliable sessions whose connection dropped, held until RESUME_GRACE runs out: {username: TimerHandle}
+detached = {}
+
+# File transfers whose senders are connected here; chunks are relayed, never stored
+file_transfers = transfers.Transfers()
+
+# Persistence happens in coalesced batches off the request path
+writer = write_behind.WriteBehind()
+# Joins heard from other workers, which may not be in storage yet: {group_name: {set of usernames}}
+remote_joins = cache.LRUCache(GROUP_CACHE_SIZE, REMOTE_WRITE_TTL)
+# Logouts heard from other workers, which may not be in storage yet: {username: time}
+remote_last_seen = cache.LRUCache(KEY_CACHE_SIZE, REMOTE_WRITE_TTL)
+# Group frames that arrived in the last GROUP_REPLAY_OVERLAP seconds, oldest first:
+# (arrived_at, group_name, frame)
+recent_group_frames = deque()
+
+async def load_public_key(username):
+    pending = writer.pending_user_key(username)
+    if pending is not None:
+        return pending
+    return await database.get_user_key_async(username)
+
+async def load_group_members(group_name):
+    members = await database.get_group_members_async(group_name)
+    members = writer.apply_pending_memberships(group_name, members)
+    # Another worker's write-behind may not have flushed a join we have already heard of
+    members.update(remote_joins.peek(group_name, ()))
+    return members
+
+def note_remote_join(username, group_name):
+    joins = remote_joins.peek(group_name) or set()
+    joins.add(username)
+    remote_joins.set(group_name, joins)  # Every join restarts the clock
+
+async def load_last_seen(username):
+    # When the user was last connected anywhere, or None if never recorded
+    seen = [await database.get_last_seen_async(username), writer.pending_last_seen(username), remote_last_seen.peek(username)]
+    seen = [when for when in seen if when is not None]
+    return max(seen) if seen else None
+
+async def get_public_key(username):
+    return await public_keys.fetch(username, load_public_key)
+
+async def load_public_keys(usernames):
+    keys = await database.get_user_keys_async(usernames)
+    for username in usernames:
+        pending = writer.pending_user_key(username)
+        if pending is not None:
+            keys[username] = pending
+    return keys
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def key_fingerprint(pem):
+    return hashlib.sha256(pem.encode("utf-8")).hexdigest()
+
+async def get_group_members(group_name):
+    return await groups.fetch(group_name, load_group_members)
+
+# Durable history of group and private traffic
+messages = message_log.MessageLog()
+
+# Frames for registered users who are not connected anywhere
+offline_queues = offline.OfflineQueues()
+
+# Users logged in on other workers, kept current by presence events on the bus
+remote_users = set()
+
+# Carries private messages, group fan-out, membership and presence between workers
+message_bus = bus.get_bus()
+
+# Event-loop lag, stalls and slow handlers, plus profile dumps on demand
+monitor = diagnostics.Watchdog()
+
+# The web client's files, served from memory on the WebSocket port
+web_client = assets.Assets()
+
+# Rate limits, size limits and the in-flight budget; reloadable at runtime
+limits = admission.Admission()
+
+async def publish_typing(typing):
+    await message_bus.publish("typing", {"typing": typing})
+
+# Online/offline and typing deltas for the members of each user's groups, sent once per tick
+presence_feed = presence.Presence(online_members, connected_users, publish_typing)
+
+CONNECTIONS = metrics.Counter("chat_connections_total", "WebSocket connections accepted.")
+ACTIONS = metrics.Counter("chat_actions_total", "Client frames received, by action.", ("action",))
+ACTION_ERRORS = metrics.Counter("chat_action_errors_total", "Action handlers that raised, by action.", ("action",))
+ACTION_SECONDS = metrics.Histogram("chat_action_seconds", "Time spent handling a client frame, by action.", ("action",))
+FANOUT_RECIPIENTS = metrics.Histogram("chat_fanout_recipients", "Local recipients per group message.", buckets=metrics.SIZE_BUCKETS)
+THROTTLED = metrics.Counter("chat_throttled_total", "Client frames rejected by admission control, by reason.", ("reason",))
+FANOUT_SECONDS = metrics.Histogram("chat_fanout_seconds", "Time spent queueing a group message for local recipients.")
+RESUMES = metrics.Counter("chat_resumes_total", "Resume requests, by result.", ("result",))
+RETRANSMITTED = metrics.Counter("chat_retransmitted_frames_total", "Unacked frames resent after a resume.")
+
+metrics.Gauge("chat_connected_users", "Users logged in on this worker.").track(lambda: len(connected_users))
+metrics.Gauge("chat_online_groups", "Groups with at least one member online on this worker.").track(lambda: len(online_members))
+metrics.Gauge("chat_remote_users", "Users logged in on other workers.").track(lambda: len(remote_users))
+metrics.Gauge("chat_outbox_frames", "Frames waiting in connection outboxes.").track(
+    lambda: sum(outbox.pending() for outbox in connected_users.values()))
+metrics.Gauge("chat_offline_frames", "Frames queued for offline users.").track(offline_queues.pending)
+metrics.Gauge("chat_in_flight", "Client frames being handled right now.").track(lambda: limits.in_flight)
+metrics.Gauge("chat_pending_writes", "Database writes waiting for the next batch.").track(writer.pending)
+metrics.Gauge("chat_detached_sessions", "Reliable sessions waiting to be resumed.").track(lambda: len(detached))
+metrics.Gauge("chat_unacked_frames", "Frames sent to reliable sessions and not yet acked.").track(
+    lambda: sum(outbox.unacked() for outbox in connected_users.values()))
+metrics.Gauge("chat_file_transfers", "File transfers with their sender on this worker.").track(file_transfers.__len__)
+CACHE_ENTRIES = metrics.Gauge("chat_cache_entries", "Entries held in memory, by cache.", ("cache",))
+CACHE_HITS = metrics.Counter("chat_cache_hits_total", "Cache lookups served from memory, by cache.", ("cache",))
+CACHE_MISSES = metrics.Counter("chat_cache_misses_total", "Cache lookups that went to the database, by cache.", ("cache",))
+for cache_name, lru in (("keys", public_keys), ("groups", groups)):
+    CACHE_ENTRIES.track(lru.__len__, cache=cache_name)
+    CACHE_HITS.track(lambda lru=lru: lru.hits, cache=cache_name)
+    CACHE_MISSES.track(lambda lru=lru: lru.misses, cache=cache_name)
+
+def index_online(username, outbox, group_names):
+    user_groups[username] = group_names
+    for group_name in group_names:
+        online_members.setdefault(group_name, {})[username] = outbox
+
+def index_join(username, group_name):
+    outbox = connected_users.get(username)
+    if outbox is not None:
+        user_groups[username].add(group_name)
+        online_members.setdefault(group_name, {})[username] = outbox
+
+def unindex_online(username):
+    # O(groups of this user), however large those groups are
+    for group_name in user_groups.pop(username, ()):
+        online = online_members.get(group_name)
+        if online is not None:
+            online.pop(username, None)
+            if not online:
+                del online_members[group_name]
+
+def deliver_group(group_name, sender, frame):
+    # Hand one shared group Frame to this worker's online members; cost scales with who is online
+    with FANOUT_SECONDS.time():
+        online = online_members.get(group_name, {})
+        recipients = [outbox for member, outbox in online.items() if member != sender]  # Don't echo back to sender
+        FANOUT_RECIPIENTS.observe(len(recipients))
+        return fanout.broadcast(recipients, frame)
+
+async def deliver_to_user(target_user, frame):
+    # Local outbox, another worker, or the offline queue for their next login
+    if not await deliver_online(target_user, frame):
+        offline_queues.put(target_user, frame)
+
+async def deliver_online(target_user, frame):
+    # True if the user is connected somewhere and the frame was handed over
+    outbox = connected_users.get(target_user)
+    if outbox is not None:
+        outbox.put(frame)
+        return True
+    return await message_bus.send_to_user(target_user, frame.json, not frame.sequenced)
+
+def remember_group(group_name, frame):
+    now = time.time()
+    recent_group_frames.append((now, group_name, frame))
+    while recent_group_frames[0][0] < now - GROUP_REPLAY_OVERLAP:
+        recent_group_frames.popleft()
+
+def recent_groups(group_names, since):
+    # Taken in the same step that makes the user live, so each frame is either here or delivered live
+    return [frame for arrived_at, group_name, frame in recent_group_frames
+            if arrived_at >= since and group_name in group_names]
+
+async def replay_groups(username, group_names, since, until, recent):
+    # Group messages sent while the user was away, up to `until` when they went live.
+    # Older than half the overlap they are in the log by now, whichever worker wrote
+    # them; newer ones are `recent`, and a message found in both is sent once.
+    if since is None or not group_names:
+        return
+    since = max(since, until - offline.OFFLINE_TTL)
+    logged_until = until - GROUP_REPLAY_OVERLAP / 2
+    payloads = []
+    if since < logged_until:
+        keys = [message_log.group_key(group_name) for group_name in group_names]
+        payloads = await messages.missed(keys, since, logged_until, offline.OFFLINE_QUEUE_SIZE)
+    in_memory = {frame.json for frame in recent}
+    frames = [protocol.Frame.from_json(text) for text in (payload.decode("utf-8") for payload in payloads)
+              if text not in in_memory]
+    frames.extend(recent)
+    for batch in offline.batch_frames(frames):
+        outbox = connected_users.get(username)
+        if outbox is None:
+            return
+        outbox.put(batch)
+
+async def flush_offline(target_user):
+    # Deliver whatever this worker queued for a user who just logged in
+    frames = offline_queues.take(target_user)
+    for batch in offline.batch_frames(frames):
+        if target_user in connected_users:
+            connected_users[target_user].put(batch)
+        else:
+            await message_bus.send_to_user(target_user, batch.json)
+
+def on_bus_deliver(target_user, frame, transient=False):
+    # Frames cross the bus as JSON text
+    outbox = connected_users.get(target_user)
+    if outbox:
+        outbox.put((protocol.TransientFrame if transient else protocol.Frame).from_json(frame))
+
+def on_bus_event(kind, payload, frame):
+    # State changes made on other workers
+    if kind == "group":
+        frame = protocol.Frame.from_json(frame)
+        remember_group(payload["group"], frame)
+        deliver_group(payload["group"], payload["from"], frame)
+    elif kind == "join":
+        note_remote_join(payload["user"], payload["group"])
+        members = groups.peek(payload["group"])
+        if members is not None:
+            members.add(payload["user"])
+        presence_feed.joined(payload["user"], payload["group"])
+        if frame:
+            deliver_group(payload["group"], payload["user"], protocol.Frame.from_json(frame))
+    elif kind == "key":
+        public_keys.set(payload["user"], payload["key"])
+    elif kind == "takeover":
+        # Logging in on another worker; a session held here for resume gives way
+        if payload["user"] in detached:
+            asyncio.create_task(end_session(payload["user"]))
+    elif kind == "presence":
+        if payload["online"]:
+            remote_users.add(payload["user"])
+            presence_feed.online(payload["user"], payload.get("groups", ()))
+            if payload["user"] in offline_queues:
+                asyncio.create_task(flush_offline(payload["user"]))
+        else:
+            remote_users.discard(payload["user"])
+            presence_feed.offline(payload["user"])
+            remote_last_seen.set(payload["user"], payload["at"])
+    elif kind == "typing":
+        for group_name, usernames in payload["typing"].items():
+            for username in usernames:
+                presence_feed.typing(username, group_name)
+    elif kind == "file_credit":
+        # Only the worker the sender is on knows the transfer
+        grant_credit(payload["transfer_id"], payload["from"], payload["next"], payload["window"], payload["restart"])
+    elif kind == "file_cancel":
+        transfer = file_transfers.get(payload["transfer_id"])
+        if transfer is not None and payload["user"] in (transfer.sender, transfer.target):
+            file_transfers.close(transfer.transfer_id)
+
+async def claim(username):
+    if await message_bus.claim(username):
+        return True
+    if not message_bus.worker_id:
+        return False
+    # The name may only be held by a dropped session on another worker; ask for it
+    await message_bus.publish("takeover", {"user": username})
+    deadline = time.monotonic() + TAKEOVER_TIMEOUT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+        if await message_bus.claim(username):
+            return True
+    return False
+
+async def end_session(username, expired=False):
+    # The user is gone for good: their name is released and the cluster told
+    handle = detached.pop(username, None)
+    if handle:
+        handle.cancel()
+    resume_tokens.pop(username, None)
+    outbox = connected_users.pop(username, None)
+    if outbox is None:
+        return
+    # Group messages from now on are replayed at their next login, on any worker
+    away = time.time()
+    writer.set_last_seen(username, away)
+    unindex_online(username)
+    presence_feed.offline(username)
+    file_transfers.close_sender(username)
+    # Frames a reliable session was never sent are delivered on the next login. Unacked
+    # ones may already be on screen, so they are kept only when a resume window ran out.
+    for frame in outbox.undelivered(unsent_only=not expired):
+        if offline.keeps(frame):
+            offline_queues.put(username, frame)
+    outbox.close()
+    # Published before the release, so a worker they log in on next has heard even if the write has not landed
+    await message_bus.publish("presence", {"user": username, "online": False, "at": away})
+    await message_bus.release(username)
+
+def expire_session(username):
+    print(f"Resume window closed: {username}")
+    detached.pop(username, None)
+    asyncio.create_task(end_session(username, expired=True))
+
+class Session:
+    """Per-connection state handed to every action handler."""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.username = None
+        # Replies stay JSON until the client picks a codec at login
+        self.codec = protocol.JSON
+
+    async def reply(self, message):
+        await self.websocket.send(self.codec.encode(message))
+
+# Action handlers by protocol code:
+# {code: (action name, handler, login required, rate limited, required fields, optional fields)}
+HANDLERS = {}
+
+def action(code, login_required=True, limited=True, required=(), optional=()):
+    # Required fields must be non-empty strings and optional ones strings if present,
+    # whatever the codec decoded, so handlers never see a list or bytes there
+    def register(handler):
+        HANDLERS[code] = (protocol.ACTION_NAMES[code], handler, login_required, limited, required, optional)
+        return handler
+    return register
+
+def invalid_field(data, required, optional):
+    for field in required:
+        if not isinstance(data.get(field), str) or not data[field]:
+            return field
+    for field in optional:
+        if data.get(field) is not None and not isinstance(data[field], str):
+            return field
+    return None
+
+@action(protocol.LOGIN, login_required=False, required=("username",), optional=("public_key",))
+async def handle_login(session, data):
+    username = data.get("username")
+    pub_key = data.get("public_key")
+
+    reliable = bool(data.get("reliable"))
+    if username in detached:
+        # Logging in afresh drops the held session; its unacked frames follow the welcome
+        await end_session(username)
+    # Claimed through the bus so the check holds across every worker
+    if username in connected_users or not await claim(username):
+        await session.reply({"status": "error", "message": "Username already taken"})
+        return
+
+    session.username = username
+    group_names = writer.apply_pending_user_groups(username, await database.get_user_groups_async(username))
+    last_seen = await load_last_seen(username)
+    # First choice from the client's "protocols" list that we support
+    negotiated = protocol.negotiate(data.get("protocols"))
+    connected_users[username] = fanout.Outbox(session.websocket, negotiated, window=ACK_WINDOW if reliable else 0)
+    index_online(username, connected_users[username], group_names)
+    # Group messages that arrived before this point are replayed, later ones are delivered live
+    back = time.time()
+    recent = recent_groups(group_names, last_seen) if last_seen is not None else []
+    # Also stored now, so a worker that dies leaves them no further back than this login
+    writer.set_last_seen(username, back)
+    presence_feed.online(username, group_names, local=True)
+    # Skip the upsert entirely when the key has not changed. Read through the cache, a
+    # pending write and storage, so a restart or an eviction does not rewrite every key.
+    if pub_key and await get_public_key(username) != pub_key:
+        public_keys.set(username, pub_key)
+        writer.add_user(username, pub_key)
+        await message_bus.publish("key", {"user": username, "key": pub_key})
+    await message_bus.publish("presence", {"user": username, "online": True, "groups": sorted(group_names)})
+    print(f"User logged in: {username}")
+    # Advertise default model to clients (can be overridden via env)
+    default_model = os.environ.get("DEFAULT_MODEL", "claude-haiku-4.5")
+    welcome = {
+        "status": "success",
+        "message": f"Welcome {username}!",
+        "default_model": default_model,
+        "protocol": negotiated.name
+    }
+    if reliable:
+        welcome["resume_token"] = resume_tokens[username] = secrets.token_urlsafe(16)
+        welcome["ack_window"] = ACK_WINDOW
+    await session.reply(welcome)
+    session.codec = negotiated
+    # Backlog goes after the welcome so the client is ready for it
+    await flush_offline(username)
+    await replay_groups(username, group_names, last_seen, back, recent)
+
+@action(protocol.RESUME, login_required=False, required=("username",))
+async def handle_resume(session, data):
+    # Picks up a dropped reliable session: no key exchange, and unacked frames are resent
+    username = data.get("username")
+    token = resume_tokens.get(username)
+    outbox = connected_users.get(username)
+    if token is None or outbox is None or outbox.closed or not secrets.compare_digest(token, str(data.get("token"))):
+        # Expired, unknown or held by another worker: log in again, reusing the stored key
+        RESUMES.inc(result="login")
+        await handle_login(session, {"username": username, "protocols": data.get("protocols"), "reliable": True})
+        return
+    try:
+        last_seq = int(data.get("last_seq") or 0)
+    except (TypeError, ValueError):
+        last_seq = 0
+    handle = detached.pop(username, None)
+    if handle:
+        handle.cancel()
+    previous = outbox.websocket
+    session.username = username
+    negotiated = protocol.negotiate(data.get("protocols"))
+    await session.reply({
+        "status": "success",
+        "message": f"Welcome back {username}!",
+        "protocol": negotiated.name,
+        "resumed": True,
+        "resume_token": token,
+        "ack_window": ACK_WINDOW
+    })
+    session.codec = negotiated
+    RETRANSMITTED.inc(outbox.attach(session.websocket, negotiated, last_seq))
+    RESUMES.inc(result="resumed")
+    print(f"User resumed: {username}")
+    if previous is not session.websocket:
+        # A half-open old connection; its handler sees the outbox has moved on
+        asyncio.create_task(previous.close())
+
+@action(protocol.ACK, limited=False)
+async def handle_ack(session, data):
+    outbox = connected_users.get(session.username)
+    if outbox is not None and outbox.websocket is session.websocket:
+        try:
+            outbox.ack(int(data.get("seq") or 0))
+        except (TypeError, ValueError):
+            pass
+
+@action(protocol.GET_KEY, login_required=False, required=("target",))
+async def handle_get_key(session, data):
+    target_user = data.get("target")
+    key = await get_public_key(target_user)
+    if key:
+        await session.reply({
+            "type": "pub_key",
+            "username": target_user,
+            "key": key,
+            "fingerprint": key_fingerprint(key)
+        })
+    else:
+        await session.reply({
+            "status": "error",
+            "message": f"User {target_user} not found or no key"
+        })
+
+@action(protocol.GET_KEYS, login_required=False)
+async def handle_get_keys(session, data):
+    # {"targets": {username: fingerprint the client already has, or null}}
+    targets = data.get("targets") or {}
+    if isinstance(targets, list) and all(isinstance(target_user, str) for target_user in targets):
+        targets = dict.fromkeys(targets)
+    if (not isinstance(targets, dict) or len(targets) > MAX_KEYS_PER_REQUEST
+            or not all(isinstance(target_user, str) for target_user in targets)):
+        await session.reply({"status": "error", "message": f"get_keys takes up to {MAX_KEYS_PER_REQUEST} string targets"})
+        return
+
+    found = await public_keys.fetch_many(list(targets), load_public_keys)
+    keys = {}
+    unchanged = []
+    missing = []
+    for target_user, known_fingerprint in targets.items():
+        key = found.get(target_user)
+        if not key:
+            missing.append(target_user)
+            continue
+        fingerprint = key_fingerprint(key)
+        # Only send the PEM when the client's copy is absent or stale
+        if fingerprint == known_fingerprint:
+            unchanged.append(target_user)
+        else:
+            keys[target_user] = {"key": key, "fingerprint": fingerprint}
+    await session.reply({
+        "type": "pub_keys",
+        "keys": keys,
+        "unchanged": unchanged,
+        "missing": missing
+    })
+
+@action(protocol.PRIVATE, required=("target",), optional=("content",))
+async def handle_private(session, data):
+    username = session.username
+    target_user = data.get("target")
+    content = data.get("content")
+
+    private = {"type": "private", "from": username, "content": content}
+    # Session key metadata is passed through untouched; the server never sees keys
+    for field in ("encrypted_key", "key_id", "control"):
+        if data.get(field) is not None:
+            private[field] = data[field]
+    frame = protocol.Frame(private)
+    if target_user in connected_users:
+        connected_users[target_user].put(frame)
+    elif await message_bus.send_to_user(target_user, frame.json):
+        pass
+    elif await get_public_key(target_user) is not None:
+        # Registered but offline everywhere: store and forward on their next login
+        offline_queues.put(target_user, frame)
+        await session.reply({"status": "success", "message": f"{target_user} is offline, message queued"})
+    else:
+        await session.reply({"status": "error", "message": f"User {target_user} not found"})
+        return
+    if not data.get("control"):
+        messages.append(message_log.private_key(username, target_user), frame.json)
+
+@action(protocol.JOIN_GROUP, required=("group",))
+async def handle_join_group(session, data):
+    username = session.username
+    group_name = data.get("group")
+    members = await get_group_members(group_name)
+    if username not in members:
+        members.add(username)
+        writer.add_to_group(username, group_name)
+        # Tells members to rotate their sender keys so the newcomer gets the next ones
+        joined = protocol.Frame({"type": "member", "group": group_name, "user": username, "joined": True})
+        deliver_group(group_name, username, joined)
+        await message_bus.publish("join", {"group": group_name, "user": username}, joined.json)
+    index_join(username, group_name)
+    presence_feed.joined(username, group_name, local=True)
+    print(f"{username} joined group {group_name}")
+    await session.reply({"status": "success", "message": f"Joined group {group_name}"})
+
+@action(protocol.GROUP, required=("group", "content"))
+async def handle_group(session, data):
+    username = session.username
+    group_name = data.get("group")
+    content = data.get("content")
+
+    if group_name in user_groups.get(username, ()):
+        # Caps how many frames one group can generate, whoever is sending
+        retry_after = limits.check_group(group_name)
+        if retry_after:
+            THROTTLED.inc(reason="group")
+            await session.reply(admission.throttled(f"Group {group_name} is over its message rate", retry_after))
+            return
+        # Encoded once per codec, then the same frame goes to every other member's outbox
+        group = {"type": "group", "group": group_name, "from": username, "content": content}
+        # Names the sender key that encrypted the content; the server never sees keys
+        if data.get("key_id") is not None:
+            group["key_id"] = data["key_id"]
+        frame = protocol.Frame(group)
+        # Offline members cost nothing here: they catch up from the log when they log in
+        remember_group(group_name, frame)
+        deliver_group(group_name, username, frame)
+        await message_bus.publish("group", {"group": group_name, "from": username}, frame.json)
+        messages.append(message_log.group_key(group_name), frame.json)
+    else:
+        await session.reply({"status": "error", "message": f"You are not in group {group_name}"})
+
+@action(protocol.MEMBERS, required=("group",))
+async def handle_members(session, data):
+    # Who a sender key has to be wrapped for
+    group_name = data.get("group")
+    if group_name not in user_groups.get(session.username, ()):
+        await session.reply({"status": "error", "message": f"You are not in group {group_name}"})
+        return
+    members = await get_group_members(group_name)
+    await session.reply({"type": "members", "group": group_name, "members": sorted(members)})
+
+@action(protocol.SENDER_KEY, required=("group",))
+async def handle_sender_key(session, data):
+    # {"group", "key_id", "envelopes": {member: key wrapped with that member's public key}}.
+    # One request from the sender; each member is sent only their own envelope.
+    username = session.username
+    group_name = data.get("group")
+    envelopes = data.get("envelopes")
+    if group_name not in user_groups.get(username, ()):
+        await session.reply({"status": "error", "message": f"You are not in group {group_name}"})
+        return
+    if not isinstance(envelopes, dict) or len(envelopes) > MAX_ENVELOPES_PER_REQUEST:
+        await session.reply({"status": "error", "message": f"sender_key takes up to {MAX_ENVELOPES_PER_REQUEST} envelopes"})
+        return
+    members = await get_group_members(group_name)
+    deliveries = []
+    for member, envelope in envelopes.items():
+        # Keys only ever go to current members
+        if member != username and member in members:
+            deliveries.append(deliver_to_user(member, protocol.Frame({
+                "type": "sender_key",
+                "group": group_name,
+                "from": username,
+                "key_id": data.get("key_id"),
+                "encrypted_key": envelope
+            })))
+    await asyncio.gather(*deliveries)
+
+@action(protocol.FILE_OFFER, required=("target",))
+async def handle_file_offer(session, data):
+    # Opens a transfer to an online user; the file follows in file_chunk frames
+    # once the target grants credit. Name and key are encrypted by the sender.
+    username = session.username
+    target_user = data.get("target")
+    transfer_id = data.get("transfer_id")
+    try:
+        size = int(data.get("size"))
+        chunk_size = int(data.get("chunk_size"))
+    except (TypeError, ValueError):
+        size = chunk_size = -1
+    if (not protocol.valid_transfer_id(transfer_id)
+            or not 0 <= size <= transfers.MAX_FILE_BYTES or chunk_size <= 0):
+        await session.reply({"status": "error", "message": "Invalid file offer", "transfer_id": transfer_id})
+        return
+    if transfers.chunk_content_bytes(chunk_size) > limits.limits["max_content_bytes"]:
+        # Every chunk would be refused, so the transfer could never finish
+        await session.reply({"status": "error", "code": "too_large", "transfer_id": transfer_id,
+                             "message": f"File chunks too large for the {limits.limits['max_content_bytes']} byte limit"})
+        return
+    existing = file_transfers.get(transfer_id)
+    if existing is not None and existing.sender != username:
+        await session.reply({"status": "error", "message": "Transfer id already in use", "transfer_id": transfer_id})
+        return
+    if file_transfers.open(transfer_id, username, target_user, -(-size // chunk_size)) is None:
+        reply = admission.throttled(f"Up to {file_transfers.max_per_user} file transfers at a time")
+        reply["transfer_id"] = transfer_id
+        await session.reply(reply)
+        return
+    offer = protocol.Frame({
+        "type": "file_offer",
+        "transfer_id": transfer_id,
+        "from": username,
+        "name": data.get("name"),
+        "size": size,
+        "chunk_size": chunk_size,
+        "encrypted_key": data.get("encrypted_key")
+    })
+    # Nothing is stored for offline users: a file is only relayed while both ends are connected
+    if not await deliver_online(target_user, offer):
+        file_transfers.close(transfer_id)
+        await session.reply({"status": "error", "message": f"{target_user} is not online", "transfer_id": transfer_id})
+
+@action(protocol.FILE_CHUNK, limited=False, required=("transfer_id",))
+async def handle_file_chunk(session, data):
+    # Not rate limited: credit already bounds how fast a transfer can go
+    transfer = file_transfers.get(data.get("transfer_id"))
+    if transfer is None or transfer.sender != session.username:
+        transfers.CHUNKS.inc(result="unknown")
+        return
+    if limits.oversized(data):
+        # Only when the limit was lowered after the offer; both ends are told it is over
+        transfers.CHUNKS.inc(result="too_large")
+        file_transfers.close(transfer.transfer_id)
+        await session.reply({"status": "error", "code": "too_large", "message": "File chunk too large",
+                             "transfer_id": transfer.transfer_id})
+        await deliver_online(transfer.target, protocol.Frame({
+            "type": "file_cancel", "transfer_id": transfer.transfer_id, "from": transfer.sender}))
+        return
+    index = data.get("index")
+    if not isinstance(index, int) or not transfer.accept(index):
+        # Sent without credit; the target asks again for whatever it is missing
+        transfers.CHUNKS.inc(result="rejected")
+        return
+    chunk = protocol.TransientFrame({
+        "type": "file_chunk",
+        "transfer_id": transfer.transfer_id,
+        "index": index,
+        "content": data.get("content")
+    })
+    if await deliver_online(transfer.target, chunk):
+        transfers.CHUNKS.inc(result="relayed")
+    else:
+        # The target dropped; it resumes with a restart grant when it is back
+        transfers.CHUNKS.inc(result="undeliverable")
+
+def grant_credit(transfer_id, receiver, next_index, window, restart):
+    transfer = file_transfers.get(transfer_id)
+    if transfer is None or transfer.target != receiver:
+        return False
+    window = transfer.grant(next_index, window, restart)
+    if next_index >= transfer.chunks:
+        file_transfers.close(transfer_id)
+    outbox = connected_users.get(transfer.sender)
+    if outbox is not None:
+        outbox.put(protocol.Frame({
+            "type": "file_credit",
+            "transfer_id": transfer_id,
+            "from": receiver,
+            "next": next_index,
+            "window": window,
+            "restart": restart
+        }))
+    return True
+
+@action(protocol.FILE_CREDIT, limited=False, required=("transfer_id",))
+async def handle_file_credit(session, data):
+    # From the target: it has stored every chunk below "next" and takes "window" more.
+    # "restart" rewinds the sender there after chunks were lost.
+    transfer_id = data.get("transfer_id")
+    next_index = data.get("next")
+    window = data.get("window")
+    if not isinstance(next_index, int) or not isinstance(window, int) or next_index < 0:
+        return
+    restart = bool(data.get("restart"))
+    if not grant_credit(transfer_id, session.username, next_index, window, restart):
+        await message_bus.publish("file_credit", {
+            "transfer_id": transfer_id,
+            "from": session.username,
+            "next": next_index,
+            "window": window,
+            "restart": restart
+        })
+
+@action(protocol.FILE_CANCEL, required=("transfer_id",), optional=("peer",))
+async def handle_file_cancel(session, data):
+    # Either end may cancel; "peer" is told so it stops too
+    username = session.username
+    transfer_id = data.get("transfer_id")
+    transfer = file_transfers.get(transfer_id)
+    if transfer is not None and username in (transfer.sender, transfer.target):
+        file_transfers.close(transfer_id)
+    else:
+        await message_bus.publish("file_cancel", {"transfer_id": transfer_id, "user": username})
+    peer = data.get("peer")
+    if peer:
+        await deliver_online(peer, protocol.Frame({"type": "file_cancel", "transfer_id": transfer_id, "from": username}))
+
+@action(protocol.TYPING, required=("group",))
+async def handle_typing(session, data):
+    # No reply: typing notices are fire-and-forget and coalesced per tick
+    group_name = data.get("group")
+    if group_name in user_groups.get(session.username, ()):
+        presence_feed.typing(session.username, group_name, local=True)
+
+@action(protocol.HISTORY, optional=("group", "with"))
+async def handle_history(session, data):
+    username = session.username
+    # Pages forward from "offset" or "since" (timestamp), otherwise backward from "before"/newest
+    group_name = data.get("group")
+    peer = data.get("with")
+    if group_name:
+        if group_name not in user_groups.get(username, ()):
+            await session.reply({"status": "error", "message": f"You are not in group {group_name}"})
+            return
+        key, conversation = message_log.group_key(group_name), {"group": group_name}
+    elif peer:
+        key, conversation = message_log.private_key(username, peer), {"with": peer}
+    else:
+        await session.reply({"status": "error", "message": "History needs a group or with"})
+        return
+
+    try:
+        offset = None if data.get("offset") is None else int(data["offset"])
+        since = None if data.get("since") is None else float(data["since"])
+        before = None if data.get("before") is None else int(data["before"])
+        limit = min(int(data.get("limit") or message_log.HISTORY_PAGE_SIZE), message_log.HISTORY_PAGE_SIZE)
+    except (TypeError, ValueError):
+        await session.reply({"status": "error", "message": "Invalid history cursor"})
+        return
+    records, next_offset = await messages.history(key, offset, since, before, max(limit, 1))
+    history = protocol.Frame.from_json(message_log.history_frame(conversation, records, next_offset))
+    await session.websocket.send(history.encode(session.codec))
+
+async def dispatch(session, code, data):
+    entry = HANDLERS.get(code)
+    if entry is None:
+        ACTIONS.inc(action="unknown")
+        return
+    name, handler, login_required, limited, required, optional = entry
+    ACTIONS.inc(action=name)
+    # Names whatever blocks the loop in a stall report or a task dump
+    asyncio.current_task().set_name(f"{name} from {session.username or 'anonymous'}")
+    if login_required and not session.username:
+        await session.reply({"status": "error", "message": "Not logged in"})
+        return
+    field = invalid_field(data, required, optional)
+    if field:
+        await session.reply({"status": "error", "message": f"Invalid or missing {field}"})
+        return
+
+    # Unlimited actions (acks, file chunks and credit) skip admission but are still timed
+    if limited:
+        # Shed load with an explicit error rather than queueing work we cannot keep up with
+        if limits.oversized(data):
+            THROTTLED.inc(reason="size")
+            await session.reply({"status": "error", "code": "too_large", "message": "Message too large"})
+            return
+        retry_after = limits.check_user(session.username or session)
+        if retry_after:
+            THROTTLED.inc(reason="user")
+            await session.reply(admission.throttled("Rate limit exceeded, slow down", retry_after))
+            return
+        if not limits.try_enter():
+            THROTTLED.inc(reason="overload")
+            await session.reply(admission.throttled("Server busy, try again later", 1))
+            return
+
+    started = time.perf_counter()
+    try:
+        await handler(session, data)
+    except websockets.exceptions.ConnectionClosed:
+        raise
+    except Exception:
+        ACTION_ERRORS.inc(action=name)
+        raise
+    finally:
+        if limited:
+            limits.leave()
+        elapsed = time.perf_counter() - started
+        ACTION_SECONDS.observe(elapsed, action=name)
+        monitor.handled(name, session.username, elapsed)
 
 async def handle_connection(websocket):
-    username = None
+    session = Session(websocket)
+    CONNECTIONS.inc()
     try:
         async for message in websocket:
-            data = json.loads(message)
-            action = data.get("action")
-
-            if action == "login":
-                username = data.get("username")
-                pub_key = data.get("public_key")
-                
-                if username in connected_users:
-                    await websocket.send(json.dumps({"status": "error", "message": "Username already taken"}))
-                    username = None 
-                else:
-                    connected_users[username] = websocket
-                    if pub_key:
-                        public_keys[username] = pub_key
-                        database.add_user(username, pub_key)
-                    print(f"User logged in: {username}")
-                    # Advertise default model to clients (can be overridden via env)
-                    default_model = os.environ.get("DEFAULT_MODEL", "claude-haiku-4.5")
-                    await websocket.send(json.dumps({
-                        "status": "success",
-                        "message": f"Welcome {username}!",
-                        "default_model": default_model
-                    }))
-
-            elif action == "get_key":
-                target_user = data.get("target")
-                if target_user in public_keys:
-                    await websocket.send(json.dumps({
-                        "type": "pub_key",
-                        "username": target_user,
-                        "key": public_keys[target_user]
-                    }))
-                else:
-                    await websocket.send(json.dumps({
-                        "status": "error", 
-                        "message": f"User {target_user} not found or no key"
-                    }))
-
-            elif action == "private":
-                if not username:
-                    await websocket.send(json.dumps({"status": "error", "message": "Not logged in"}))
-                    continue
-                
-                target_user = data.get("target")
-                content = data.get("content")
-                
-                if target_user in connected_users:
-                    try:
-                        await connected_users[target_user].send(json.dumps({
-                            "type": "private",
-                            "from": username,
-                            "content": content
-                        }))
-                    except websockets.exceptions.ConnectionClosed:
-                        del connected_users[target_user]
-                else:
-                     await websocket.send(json.dumps({"status": "error", "message": f"User {target_user} not found"}))
-
-            elif action == "join_group":
-                if not username:
-                    await websocket.send(json.dumps({"status": "error", "message": "Not logged in"}))
-                    continue
-
-                group_name = data.get("group")
-                if group_name not in groups:
-                    groups[group_name] = set()
-                groups[group_name].add(username)
-                database.add_to_group(username, group_name)
-                print(f"{username} joined group {group_name}")
-                await websocket.send(json.dumps({"status": "success", "message": f"Joined group {group_name}"}))
-
-            elif action == "group":
-                if not username:
-                    await websocket.send(json.dumps({"status": "error", "message": "Not logged in"}))
-                    continue
-
-                group_name = data.get("group")
-                content = data.get("content")
-
-                if group_name in groups and username in groups[group_name]:
-                    # Broadcast to others in the group
-                    for member in groups[group_name]:
-                        if member != username: # Don't echo back to sender
-                            if member in connected_users:
-                                try:
-                                    await connected_users[member].send(json.dumps({
-                                        "type": "group",
-                                        "group": group_name,
-                                        "from": username,
-                                        "content": content
-                                    }))
-                                except websockets.exceptions.ConnectionClosed:
-                                    pass # Handle lazy cleanup elsewhere or let it fail
-                else:
-                     await websocket.send(json.dumps({"status": "error", "message": f"You are not in group {group_name}"}))
+            # Decoded once; text frames are JSON, binary frames use the binary codec
+            try:
+                code, data = protocol.decode(message)
+            except ValueError:
+                ACTIONS.inc(action="malformed")
+                await session.reply({"status": "error", "message": "Malformed frame"})
+                continue
+            await dispatch(session, code, data)
 
     except websockets.exceptions.ConnectionClosed:
         pass
     finally:
-        if username:
-            print(f"User disconnected: {username}")
-            if username in connected_users:
-                del connected_users[username]
-            # Remove from all groups - DISABLED FOR PERSISTENCE
-            # for group_name in groups:
-            #     if username in groups[group_name]:
-            #         groups[group_name].remove(username)
-
-async def main():
-    async with websockets.serve(handle_connection, "localhost", 8765):
-        print("Server started on ws://localhost:8765")
-        await asyncio.get_running_loop().create_future()  # Run forever
+        username = session.username
+        outbox = connected_users.get(username) if username else None
+        # Skipped when a resume has already moved the session to a newer connection
+        if outbox is not None and outbox.websocket is websocket:
+            # A normal close is a logout; any other drop may come back with a resume
+            if outbox.resumable and not outbox.closed and websocket.close_code != 1000:
+                print(f"User detached: {username}")
+                detached[username] = asyncio.get_running_loop().call_later(RESUME_GRACE, expire_session, username)
+            else:
+                print(f"User disconnected: {username}")
+                await end_session(username)
+
+async def process_request(path, request_headers):
+    # Plain HTTP on the WebSocket port; upgrade requests go on to the handshake
+    if request_headers.get("Upgrade", "").lower() == "websocket":
+        return None
+    if path == "/metrics":
+        body = metrics.render(**({"worker": message_bus.worker_id} if message_bus.worker_id else {}))
+        return HTTPStatus.OK, [("Content-Type", metrics.CONTENT_TYPE)], body.encode("utf-8")
+    if path == "/debug/profile":
+        return monitor.respond(request_headers)
+    return web_client.respond(path, request_headers)
+
+def stop(stopping, status=0):
+    if not stopping.done():
+        stopping.set_result(status)
+
+async def main(reuse_port=False):
+    # systemd and docker stop with SIGTERM; it drains and closes like Ctrl-C does
+    stopping = asyncio.get_running_loop().create_future()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop, stopping)
+    monitor.start()
+    writer.start()
+    messages.start()
+    offline_queues.start()
+    limits.start()
+    presence_feed.start()
+    web_client.load()
+    # Without the hub, logins and routing cannot work: stop so the cluster notices
+    remote_users.update(await message_bus.start(on_bus_event, on_bus_deliver, functools.partial(stop, stopping, 1)))
+    try:
+        extensions = [ServerPerMessageDeflateFactory(
+            server_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+            client_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+            compress_settings={"memLevel": WS_DEFLATE_MEM_LEVEL},
+        )] if WS_COMPRESSION else []
+        async with websockets.serve(handle_connection, HOST, PORT, reuse_port=reuse_port,
+                                    compression=None, extensions=extensions,
+                                    process_request=process_request, max_size=admission.MAX_FRAME_BYTES):
+            if message_bus.worker_id:
+                print(f"Worker {message_bus.worker_id} serving ws://{HOST}:{PORT}")
+            else:
+                print(f"Server started on ws://{HOST}:{PORT}")
+            # Caches start empty, so this no longer grows with the number of registered users
+            startup_ms = (time.perf_counter() - STARTUP_BEGAN) * 1000
+            peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            print(f"Startup took {startup_ms:.1f} ms, peak RSS {peak_rss_mb:.1f} MB")
+            return await stopping
+    finally:
+        await message_bus.close()
+        presence_feed.close()
+        monitor.close()
+        limits.close()
+        offline_queues.close()
+        await messages.close()
+        await writer.close()
+        database.close()
+
+def run_worker(address):
+    global message_bus
+    message_bus = bus.RemoteBus(address)
+    try:
+        sys.exit(asyncio.run(main(reuse_port=True)))
+    except KeyboardInterrupt:
+        pass
+
+async def run_cluster(workers):
+    # The hub lives in this process; workers are spawned and connect back to it
+    address = bus.BUS_ADDRESS or f"unix:/tmp/chat-bus-{os.getpid()}.sock"
+    hub = await bus.BusHub().serve(address)
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_worker, args=(address,)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    def dump_workers():
+        # A dump asked of the cluster is taken by every worker
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGUSR1)
+
+    def worker_exited(process):
+        # Nothing restarts a worker here: a dead one (say, it could not bind) stops
+        # the cluster with an error, so whatever supervises the server restarts it whole
+        loop.remove_reader(process.sentinel)
+        process.join(1)  # Already gone; this only reaps it for the exit code
+        print(f"Worker process {process.pid} exited with code {process.exitcode}")
+        stop(stopping, 1)
+
+    loop = asyncio.get_running_loop()
+    stopping = loop.create_future()
+    loop.add_signal_handler(signal.SIGUSR1, dump_workers)
+    loop.add_signal_handler(signal.SIGTERM, stop, stopping)
+    for process in processes:
+        loop.add_reader(process.sentinel, worker_exited, process)
+    print(f"Server started on ws://{HOST}:{PORT} with {workers} workers")
+    try:
+        async with hub:
+            return await stopping
+    finally:
+        for process in processes:
+            loop.remove_reader(process.sentinel)
+        # SIGTERM lets each worker drain its write-behind queue and message log before exiting
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        for process in processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if WORKERS > 1:
+        status = 0
+        try:
+            status = asyncio.run(run_cluster(WORKERS))
+        except KeyboardInterrupt:
+            pass
+        print("\nServer stopped.")
+        sys.exit(status)
+    else:
+        sys.exit(asyncio.run(main()))
@@ -0,0 +1,101 @@
+import os
+
+import metrics
+
+# Chunks a receiver may grant beyond what it has stored. With the sender only
+# allowed to send granted chunks, this is all the server ever holds per transfer.
+FILE_WINDOW = int(os.environ.get("FILE_WINDOW", "8"))
+# Open outgoing transfers per user; further offers are refused until one ends
+MAX_TRANSFERS_PER_USER = int(os.environ.get("MAX_TRANSFERS_PER_USER", "4"))
+# Largest file that can be offered, in bytes
+MAX_FILE_BYTES = int(os.environ.get("MAX_FILE_BYTES", str(4 * 1024 ** 3)))
+
+CHUNKS = metrics.Counter("chat_file_chunks_total", "File chunks received from senders, by result.", ("result",))
+
+
+def chunk_content_bytes(chunk_size):
+    # Base64 length of the Fernet token carrying one chunk and its 4-byte index:
+    # version, timestamp, IV, the AES-CBC padded data and the HMAC
+    token = 1 + 8 + 16 + ((chunk_size + 4) // 16 + 1) * 16 + 32
+    return 4 * -(-token // 3)
+
+
+class Transfer:
+    """One file on its way from sender to target, tracked on the sender's worker."""
+
+    __slots__ = ("transfer_id", "sender", "target", "chunks", "next", "limit")
+
+    def __init__(self, transfer_id, sender, target, chunks):
+        self.transfer_id = transfer_id
+        self.sender = sender
+        self.target = target
+        self.chunks = chunks
+        self.next = 0  # Index of the next chunk accepted from the sender
+        self.limit = 0  # Chunks below this index have been granted by the target
+
+    @property
+    def complete(self):
+        return self.next >= self.chunks
+
+    def grant(self, next_index, window, restart=False):
+        """Applies the target's credit; returns the window actually granted.
+
+        Grants are absolute, so a lost or repeated one never leaks credit. With
+        restart the target lost chunks and the sender rewinds to next_index.
+        """
+        window = max(0, min(window, FILE_WINDOW))
+        if restart:
+            self.next = next_index
+            self.limit = next_index + window
+        else:
+            self.limit = max(self.limit, next_index + window)
+        return window
+
+    def accept(self, index):
+        # Only the next granted chunk is relayed, so nothing is buffered out of order
+        if index != self.next or index >= self.limit or index >= self.chunks:
+            return False
+        self.next += 1
+        return True
+
+
+class Transfers:
+    """The open transfers whose senders are connected to this worker."""
+
+    def __init__(self, max_per_user=MAX_TRANSFERS_PER_USER):
+        self.max_per_user = max_per_user
+        self._transfers = {}  # {transfer id: Transfer}
+        self._by_sender = {}  # {username: set of transfer ids}
+
+    def __len__(self):
+        return len(self._transfers)
+
+    def get(self, transfer_id):
+        return self._transfers.get(transfer_id)
+
+    def open(self, transfer_id, sender, target, chunks):
+        """Returns the new Transfer, or None if the sender already has too many open.
+
+        Offering an id again (after reconnecting) starts it over.
+        """
+        owned = self._by_sender.setdefault(sender, set())
+        if transfer_id not in owned and len(owned) >= self.max_per_user:
+            return None
+        owned.add(transfer_id)
+        transfer = self._transfers[transfer_id] = Transfer(transfer_id, sender, target, chunks)
+        return transfer
+
+    def close(self, transfer_id):
+        transfer = self._transfers.pop(transfer_id, None)
+        if transfer is not None:
+            owned = self._by_sender.get(transfer.sender)
+            if owned is not None:
+                owned.discard(transfer_id)
+                if not owned:
+                    del self._by_sender[transfer.sender]
+        return transfer
+
+    def close_sender(self, username):
+        # The sender re-offers whatever is unfinished when it logs in again
+        for transfer_id in self._by_sender.pop(username, ()):
+            self._transfers.pop(transfer_id, None)
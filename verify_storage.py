@@ -0,0 +1,93 @@
+import os
+import sys
+import tempfile
+import uuid
+
+import database
+
+# Runs the same storage contract against each engine:
+#   python verify_storage.py                       memory and a throwaway SQLite file
+#   python verify_storage.py postgresql://...      any DATABASE_URL (rows use a random prefix)
+
+
+def check(failures, label, actual, expected):
+    if actual != expected:
+        failures.append(f"{label}: expected {expected!r}, got {actual!r}")
+
+
+def verify(url):
+    engine = database.load_engine(url)
+    failures = []
+    # Unique names so a shared Postgres database never collides with real users
+    p = f"verify-{uuid.uuid4().hex[:8]}-"
+    alice, bob, carol, ghost = p + "alice", p + "bob", p + "carol", p + "ghost"
+    team, other = p + "team", p + "other"
+    try:
+        if not engine.init_db():
+            return ["init_db failed: storage unavailable"]
+        check(failures, "init_db is repeatable", engine.init_db(), True)
+
+        check(failures, "unknown key", engine.get_user_key(ghost), None)
+        engine.add_user(alice, "key-a1")
+        check(failures, "key after add_user", engine.get_user_key(alice), "key-a1")
+        engine.add_user(alice, "key-a2")
+        check(failures, "add_user replaces the key", engine.get_user_key(alice), "key-a2")
+
+        check(failures, "add_users", engine.add_users([(bob, "key-b"), (carol, "key-c")]), True)
+        check(failures, "add_users upserts", engine.add_users([(carol, "key-c2")]), True)
+        check(failures, "get_user_keys", engine.get_user_keys([alice, carol, ghost]), {alice: "key-a2", carol: "key-c2"})
+        check(failures, "get_user_keys with no names", engine.get_user_keys([]), {})
+        users = engine.get_all_users()
+        check(failures, "get_all_users", {u: users.get(u) for u in (alice, bob, carol)},
+              {alice: "key-a2", bob: "key-b", carol: "key-c2"})
+
+        check(failures, "empty group", engine.get_group_members(team), set())
+        engine.add_to_group(alice, team)
+        engine.add_to_group(alice, team)
+        check(failures, "add_to_group is idempotent", engine.get_group_members(team), {alice})
+        check(failures, "add_to_groups", engine.add_to_groups([(team, bob), (team, ghost), (other, carol)]), True)
+        check(failures, "add_to_groups skips unregistered users", engine.get_group_members(team), {alice, bob})
+        check(failures, "add_to_groups repeated", engine.add_to_groups([(team, bob)]), True)
+        check(failures, "get_user_groups", (engine.get_user_groups(alice), engine.get_user_groups(carol), engine.get_user_groups(ghost)),
+              ({team}, {other}, set()))
+        groups = engine.get_all_groups()
+        check(failures, "get_all_groups", {g: groups.get(g) for g in (team, other)}, {team: {alice, bob}, other: {carol}})
+
+        engine.remove_user_from_group(alice, team)
+        check(failures, "remove_user_from_group", engine.get_group_members(team), {bob})
+        check(failures, "remove_users_from_groups", engine.remove_users_from_groups([(team, bob), (other, carol), (other, ghost)]), True)
+        check(failures, "groups empty after removal", (engine.get_group_members(team), engine.get_group_members(other)), (set(), set()))
+
+        check(failures, "unknown last seen", engine.get_last_seen(ghost), None)
+        check(failures, "set_last_seen", engine.set_last_seen([(alice, 100.5), (ghost, 50.0)]), True)
+        check(failures, "last seen without a key", engine.get_last_seen(ghost), 50.0)
+        engine.set_last_seen([(alice, 200.25)])
+        engine.set_last_seen([(alice, 150.0)])
+        check(failures, "last seen only moves forward", engine.get_last_seen(alice), 200.25)
+    except Exception as e:
+        failures.append(f"raised {type(e).__name__}: {e}")
+    finally:
+        engine.close()
+    return failures
+
+
+def main():
+    urls = sys.argv[1:]
+    if not urls:
+        urls = ["memory://", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "verify.db")]
+    failed = False
+    for url in urls:
+        failures = verify(url)
+        name = url.split("://")[0]
+        if failures:
+            failed = True
+            print(f"FAILED {name}:")
+            for failure in failures:
+                print(f"  {failure}")
+        else:
+            print(f"OK {name}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,18 @@ const messagesArea = document.getElementById('messages-area');
 const messageInput = document.getElementById('message-input');
 const chatTargetLabel = document.getElementById('chat-target');
 const groupsList = document.getElementById('groups-list');
+const usersList = document.getElementById('users-list');
+const typingIndicator = document.getElementById('typing-indicator');
+
+// Members of my groups who are online, kept current by presence deltas
+const onlineUsers = new Set();
+// {group: {username: time the indicator expires}}
+const typingUsers = {};
+// Typing notices are sent at most this often; the server drops extra ones anyway
+const TYPING_INTERVAL_MS = 3000;
+// An indicator disappears when no notice arrived for this long
+const TYPING_SHOW_MS = 5000;
+let lastTypingSent = 0;
 
 function login() {
     const input = document.getElementById('username-input');
@@ -18,7 +30,9 @@ function login() {
 }
 
 function connectWebSocket() {
-    socket = new WebSocket("ws://localhost:8765");
+    // Served by the chat server itself, so the socket is on the same host and port
+    const scheme = location.protocol === "https:" ? "wss" : "ws";
+    socket = new WebSocket(`${scheme}://${location.host || "localhost:8765"}`);
 
     socket.onopen = () => {
         console.log("Connected to server");
@@ -45,11 +59,19 @@ function connectWebSocket() {
 }
 
 function handleMessage(data) {
-    if (data.status === "success") {
+    if (data.type === "batch") {
+        // Messages that were queued while we were offline
+        data.frames.forEach(handleMessage);
+    } else if (data.status === "success") {
         addSystemMessage(data.message);
     } else if (data.status === "error") {
         addSystemMessage(`Error: ${data.message}`);
+    } else if (data.type === "presence") {
+        handlePresence(data);
     } else if (data.type === "group") {
+        // A message ends that sender's typing indicator
+        if (typingUsers[data.group]) delete typingUsers[data.group][data.from];
+        renderTyping();
         // Group Message
         if (currentTarget.type === 'group' && currentTarget.name === data.group) {
             addMessageBubble(data.from, data.content, false);
@@ -66,6 +88,54 @@ function handleMessage(data) {
     }
 }
 
+function handlePresence(data) {
+    // One delta per server tick: who came online, who left, who is typing where
+    (data.online || []).forEach(user => onlineUsers.add(user));
+    (data.offline || []).forEach(user => onlineUsers.delete(user));
+    const expires = Date.now() + TYPING_SHOW_MS;
+    for (const [group, users] of Object.entries(data.typing || {})) {
+        typingUsers[group] = typingUsers[group] || {};
+        users.forEach(user => { typingUsers[group][user] = expires; });
+    }
+    renderUsers();
+    renderTyping();
+    if (data.typing) setTimeout(renderTyping, TYPING_SHOW_MS);
+}
+
+function renderUsers() {
+    usersList.innerHTML = '';
+    [...onlineUsers].sort().forEach(user => {
+        const row = document.createElement('div');
+        row.className = "px-3 py-2 text-sm text-gray-300 flex items-center gap-2";
+        const dot = document.createElement('span');
+        dot.className = "w-2 h-2 rounded-full bg-green-500";
+        const name = document.createElement('span');
+        name.innerText = user;
+        row.appendChild(dot);
+        row.appendChild(name);
+        usersList.appendChild(row);
+    });
+}
+
+function renderTyping() {
+    const now = Date.now();
+    const typing = typingUsers[currentTarget.name] || {};
+    const users = Object.keys(typing).filter(user => typing[user] > now);
+    if (currentTarget.type !== 'group' || users.length === 0) {
+        typingIndicator.innerText = '';
+    } else {
+        typingIndicator.innerText = `${users.join(', ')} ${users.length === 1 ? 'is' : 'are'} typing...`;
+    }
+}
+
+function notifyTyping() {
+    if (currentTarget.type !== 'group' || !messageInput.value) return;
+    const now = Date.now();
+    if (now - lastTypingSent < TYPING_INTERVAL_MS) return;
+    lastTypingSent = now;
+    socket.send(JSON.stringify({ action: "typing", group: currentTarget.name }));
+}
+
 function joinGroupPrompt() {
     const groupName = prompt("Enter Group Name to Join:");
     if (groupName) {
@@ -99,6 +169,7 @@ function switchToGroup(groupName) {
     chatTargetLabel.innerText = `# ${groupName}`;
     messagesArea.innerHTML = ''; // Clear view
     addSystemMessage(`Switched to channel #${groupName}`);
+    renderTyping();
 }
 
 function sendMessage() {
@@ -122,6 +193,7 @@ function sendMessage() {
     }
 
     messageInput.value = "";
+    lastTypingSent = 0;
 }
 
 function handleKeyPress(e) {
@@ -0,0 +1,138 @@
+import asyncio
+import os
+
+import database
+
+# Flush as soon as this many distinct writes are pending...
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "500"))
+# ...or after this many seconds, whichever comes first
+WRITE_FLUSH_INTERVAL = float(os.environ.get("WRITE_FLUSH_INTERVAL", "0.5"))
+
+
+class WriteBehind:
+    """Coalesces user/membership/last-seen writes in memory and persists them in multi-row batches."""
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Pending writes, keyed so repeated writes for the same key collapse into one
+        self._users = {}  # {username: public_key}
+        self._joins = set()  # {(group_name, username)}
+        self._leaves = set()  # {(group_name, username)}
+        self._seen = {}  # {username: last seen time}
+        # The batch currently being written, still visible to readers until it lands
+        self._flushing = ({}, set(), set(), {})
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._closing = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def pending(self):
+        return len(self._users) + len(self._joins) + len(self._leaves) + len(self._seen)
+
+    def add_user(self, username, public_key):
+        self._users[username] = public_key
+        self._check_size()
+
+    def add_to_group(self, username, group_name):
+        key = (group_name, username)
+        self._leaves.discard(key)
+        self._joins.add(key)
+        self._check_size()
+
+    def remove_user_from_group(self, username, group_name):
+        key = (group_name, username)
+        self._joins.discard(key)
+        self._leaves.add(key)
+        self._check_size()
+
+    def set_last_seen(self, username, when):
+        self._seen[username] = max(when, self._seen.get(username, when))
+        self._check_size()
+
+    # Reads that go to the database must see writes that have not been flushed yet
+    def pending_user_key(self, username):
+        return self._users.get(username, self._flushing[0].get(username))
+
+    def pending_last_seen(self, username):
+        return self._seen.get(username, self._flushing[3].get(username))
+
+    def apply_pending_memberships(self, group_name, members):
+        # Older (in-flight) changes first, so newer pending ones win
+        for joins, leaves in ((self._flushing[1], self._flushing[2]), (self._joins, self._leaves)):
+            for pending_group, username in joins:
+                if pending_group == group_name:
+                    members.add(username)
+            for pending_group, username in leaves:
+                if pending_group == group_name:
+                    members.discard(username)
+        return members
+
+    def apply_pending_user_groups(self, username, group_names):
+        for joins, leaves in ((self._flushing[1], self._flushing[2]), (self._joins, self._leaves)):
+            for group_name, pending_user in joins:
+                if pending_user == username:
+                    group_names.add(group_name)
+            for group_name, pending_user in leaves:
+                if pending_user == username:
+                    group_names.discard(group_name)
+        return group_names
+
+    def _check_size(self):
+        if self.pending() >= self.batch_size:
+            self._full.set()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            users, self._users = self._users, {}
+            joins, self._joins = self._joins, set()
+            leaves, self._leaves = self._leaves, set()
+            seen, self._seen = self._seen, {}
+            self._flushing = (users, joins, leaves, seen)
+
+            # Users first: memberships reference them
+            if users and not await database.add_users_async(list(users.items())):
+                self._requeue_users(users)
+            if joins and not await database.add_to_groups_async(list(joins)):
+                self._requeue_memberships(joins, self._joins, self._leaves)
+            if leaves and not await database.remove_users_from_groups_async(list(leaves)):
+                self._requeue_memberships(leaves, self._leaves, self._joins)
+            if seen and not await database.set_last_seen_async(list(seen.items())):
+                self._requeue_last_seen(seen)
+            self._flushing = ({}, set(), set(), {})
+
+    def _requeue_users(self, users):
+        # Anything written since the failed batch was taken is newer and wins
+        for username, public_key in users.items():
+            self._users.setdefault(username, public_key)
+
+    def _requeue_last_seen(self, seen):
+        # Whichever is newer wins, like the database upsert
+        for username, when in seen.items():
+            self._seen[username] = max(when, self._seen.get(username, when))
+
+    def _requeue_memberships(self, failed, target, opposite):
+        for key in failed:
+            if key not in opposite:
+                target.add(key)
+
+    async def close(self):
+        # Drain everything still pending before the database pool goes away.
+        # The flusher is stopped rather than cancelled so an in-flight batch is not lost.
+        self._closing = True
+        self._full.set()
+        if self._task:
+            await self._task
+        await self.flush()